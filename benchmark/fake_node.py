@@ -0,0 +1,306 @@
+"""
+本地模拟以太坊节点
+
+按种子确定性生成块与交易, 提供扫链用到的 JSON-RPC 方法, 用于在没有真实节点时测量扫链吞吐.
+可配置每块交易数、代币转账比例、充值命中率、响应延迟, 并可在扫链过程中注入重组.
+
+单独启动:
+    python3 -m benchmark.fake_node --port 18545 --start 1000000 --blocks 2000 --txs 150
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tasks.eth_rpc import TRANSFER_TOPIC, TRANSFER_SELECTOR
+
+# 模拟的代币合约
+TOKEN_CONTRACT = '0x' + hashlib.sha256(b'benchmark-token').hexdigest()[:40]
+BLOCK_TIME = 12
+GENESIS_TIME = 1600000000
+
+
+def _hash(*parts):
+    return '0x' + hashlib.sha256(':'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def _address(*parts):
+    return _hash(*parts)[:42]
+
+
+def deposit_addresses(count, seed=0):
+    """模拟充值地址, 压测前写入地址表"""
+    return [_address('deposit', seed, idx) for idx in range(count)]
+
+
+class SyntheticChain(object):
+    """
+    确定性模拟链
+    :param start_height: 起始高度
+    :param head_height: 节点最新高度
+    :param txs_per_block: 每块交易数
+    :param erc20_ratio: 代币转账交易比例
+    :param hit_rate: 收款地址为充值地址的交易比例
+    :param addresses: 充值地址数量
+    :param reorg_every: 每隔多少个块注入一次重组, 0 为不注入
+    :param reorg_depth: 重组深度
+    :param seed: 随机种子
+    """
+
+    def __init__(self, start_height, head_height, txs_per_block=150, erc20_ratio=0.3, hit_rate=0.01,
+                 addresses=1000, reorg_every=0, reorg_depth=3, seed=0):
+        self.start_height = start_height
+        self.head_height = head_height
+        self.txs_per_block = txs_per_block
+        self.erc20_ratio = erc20_ratio
+        self.hit_rate = hit_rate
+        self.seed = seed
+        self.deposits = deposit_addresses(addresses, seed)
+        self.reorg_depth = reorg_depth
+        # 待触发的分叉高度, 节点返回过 分叉高度 + reorg_depth 的块后生效
+        self.pending_forks = []
+        if reorg_every:
+            self.pending_forks = list(range(start_height + reorg_every, head_height, reorg_every))
+        self.forks = []
+        self._lock = threading.Lock()
+
+    def _epoch(self, height):
+        """高度所在分支的编号, 每个已生效的分叉点使其后的块全部变化"""
+        return sum(1 for fork in self.forks if fork <= height)
+
+    def served(self, height):
+        """节点返回了 height 的块, 触发已到期的重组"""
+        with self._lock:
+            while self.pending_forks and height >= self.pending_forks[0] + self.reorg_depth:
+                self.forks.append(self.pending_forks.pop(0))
+
+    def block_hash(self, height):
+        return _hash('block', self.seed, height, self._epoch(height))
+
+    def block(self, height, full_tx=True):
+        if height < 0 or height > self.head_height:
+            return None
+        block_hash = self.block_hash(height)
+        txs = self.transactions(height, block_hash)
+        return {
+            "number": hex(height),
+            "hash": block_hash,
+            "parentHash": self.block_hash(height - 1),
+            "timestamp": hex(GENESIS_TIME + height * BLOCK_TIME),
+            "miner": _address('miner', height % 7),
+            "gasLimit": hex(30000000),
+            "gasUsed": hex(21000 * len(txs)),
+            "transactions": txs if full_tx else [tx['hash'] for tx in txs],
+        }
+
+    def transactions(self, height, block_hash):
+        rnd = random.Random('{}:{}:{}'.format(self.seed, height, block_hash))
+        txs = []
+        for idx in range(self.txs_per_block):
+            if rnd.random() < self.hit_rate:
+                receiver = rnd.choice(self.deposits)
+            else:
+                receiver = _address('other', rnd.getrandbits(64))
+            value = rnd.randint(1, 10 ** 20)
+            tx = {
+                "hash": self.tx_hash(height, idx, block_hash),
+                "blockHash": block_hash,
+                "blockNumber": hex(height),
+                "transactionIndex": hex(idx),
+                "from": _address('sender', rnd.getrandbits(64)),
+                "gas": hex(60000),
+                "gasPrice": hex(20 * 10 ** 9),
+                "nonce": hex(rnd.getrandbits(16)),
+                "v": "0x25",
+                "r": _hash('r', idx),
+                "s": _hash('s', idx),
+            }
+            if rnd.random() < self.erc20_ratio:
+                tx.update({
+                    "to": TOKEN_CONTRACT, "value": "0x0",
+                    "input": TRANSFER_SELECTOR + receiver[2:].rjust(64, '0') + '{:064x}'.format(value),
+                })
+            else:
+                tx.update({"to": receiver, "value": hex(value), "input": "0x"})
+            txs.append(tx)
+        return txs
+
+    @staticmethod
+    def tx_hash(height, idx, block_hash):
+        """交易 hash 前 24 位为高度及序号, 按 hash 查询时无需遍历"""
+        return '0x{:016x}{:08x}'.format(height, idx) + _hash('tx', block_hash, idx)[26:]
+
+    def receipts(self, height):
+        block = self.block(height)
+        if block is None:
+            return None
+        return [self._receipt(tx) for tx in block['transactions']]
+
+    def receipt(self, tx_hash):
+        tx = self.find_transaction(tx_hash)
+        return tx and self._receipt(tx)
+
+    def _receipt(self, tx):
+        logs = []
+        if tx['to'] == TOKEN_CONTRACT:
+            logs.append(self._transfer_log(tx))
+        return {
+            "transactionHash": tx['hash'], "transactionIndex": tx['transactionIndex'],
+            "blockHash": tx['blockHash'], "blockNumber": tx['blockNumber'],
+            "from": tx['from'], "to": tx['to'], "gasUsed": hex(21000 if not logs else 52000),
+            "cumulativeGasUsed": hex(21000), "status": "0x1", "logs": logs,
+        }
+
+    @staticmethod
+    def _transfer_log(tx):
+        data = tx['input']
+        return {
+            "address": TOKEN_CONTRACT, "blockHash": tx['blockHash'], "blockNumber": tx['blockNumber'],
+            "transactionHash": tx['hash'], "transactionIndex": tx['transactionIndex'], "logIndex": "0x0",
+            "removed": False, "data": '0x' + data[74:138],
+            "topics": [TRANSFER_TOPIC, '0x' + tx['from'][2:].rjust(64, '0'), '0x' + data[10:74]],
+        }
+
+    def find_transaction(self, tx_hash):
+        tx_hash = tx_hash.lower()
+        try:
+            height, idx = int(tx_hash[2:18], 16), int(tx_hash[18:26], 16)
+        except ValueError:
+            return None
+        block = self.block(height)
+        if block is None or idx >= len(block['transactions']):
+            return None
+        tx = block['transactions'][idx]
+        return tx if tx['hash'] == tx_hash else None
+
+    def logs(self, from_height, to_height, contracts, topics):
+        if TOKEN_CONTRACT not in [contract.lower() for contract in contracts or [TOKEN_CONTRACT]]:
+            return []
+        if topics and topics[0] not in (None, TRANSFER_TOPIC):
+            return []
+        logs = []
+        for height in range(from_height, min(to_height, self.head_height) + 1):
+            for tx in self.block(height)['transactions']:
+                if tx['to'] == TOKEN_CONTRACT:
+                    logs.append(self._transfer_log(tx))
+        return logs
+
+
+class FakeNodeHandler(BaseHTTPRequestHandler):
+    chain = None
+    latency = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.latency:
+            time.sleep(self.latency)
+        if isinstance(body, list):
+            result = [self.call(item) for item in body]
+        else:
+            result = self.call(body)
+        data = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def call(self, item):
+        method, params = item.get('method'), item.get('params') or []
+        rsp = {"jsonrpc": "2.0", "id": item.get('id')}
+        handler = getattr(self, 'rpc_' + method, None)
+        if handler is None:
+            rsp['error'] = {"code": -32601, "message": "the method {} does not exist".format(method)}
+            return rsp
+        rsp['result'] = handler(*params)
+        return rsp
+
+    @staticmethod
+    def _height(tag):
+        if tag in ('latest', 'pending', 'safe', 'finalized'):
+            return FakeNodeHandler.chain.head_height
+        if tag == 'earliest':
+            return 0
+        return int(tag, 16)
+
+    def rpc_eth_blockNumber(self):
+        return hex(self.chain.head_height)
+
+    def rpc_eth_syncing(self):
+        return False
+
+    def rpc_eth_chainId(self):
+        return '0x539'
+
+    def rpc_net_version(self):
+        return '1337'
+
+    def rpc_eth_gasPrice(self):
+        return hex(20 * 10 ** 9)
+
+    def rpc_eth_getBlockByNumber(self, tag, full_tx=False):
+        height = self._height(tag)
+        block = self.chain.block(height, full_tx)
+        self.chain.served(height)
+        return block
+
+    def rpc_eth_getBlockReceipts(self, tag):
+        return self.chain.receipts(self._height(tag))
+
+    def rpc_eth_getTransactionReceipt(self, tx_hash):
+        return self.chain.receipt(tx_hash)
+
+    def rpc_eth_getTransactionByHash(self, tx_hash):
+        return self.chain.find_transaction(tx_hash)
+
+    def rpc_eth_getLogs(self, log_filter):
+        address = log_filter.get('address')
+        if isinstance(address, str):
+            address = [address]
+        return self.chain.logs(self._height(log_filter.get('fromBlock', 'latest')),
+                               self._height(log_filter.get('toBlock', 'latest')),
+                               address, log_filter.get('topics'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, latency=0, host='127.0.0.1', ready=None, **chain_kwargs):
+    """
+    启动模拟节点, 阻塞运行
+    :param latency: 每个 HTTP 请求的额外延迟, 秒
+    :param ready: multiprocessing.Event, 开始监听后设置
+    """
+    FakeNodeHandler.chain = SyntheticChain(**chain_kwargs)
+    FakeNodeHandler.latency = latency
+    server = ThreadingHTTPServer((host, port), FakeNodeHandler)
+    server.daemon_threads = True
+    if ready is not None:
+        ready.set()
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟以太坊节点')
+    parser.add_argument('--port', type=int, default=18545)
+    parser.add_argument('--start', type=int, default=1000000, help='起始高度')
+    parser.add_argument('--blocks', type=int, default=2000, help='起始高度之后的块数')
+    parser.add_argument('--txs', type=int, default=150, help='每块交易数')
+    parser.add_argument('--erc20-ratio', type=float, default=0.3, help='代币转账比例')
+    parser.add_argument('--hit-rate', type=float, default=0.01, help='充值命中率')
+    parser.add_argument('--addresses', type=int, default=1000, help='充值地址数量')
+    parser.add_argument('--latency-ms', type=float, default=0, help='每个请求的额外延迟, 毫秒')
+    parser.add_argument('--reorg-every', type=int, default=0, help='每隔多少块注入一次重组')
+    parser.add_argument('--reorg-depth', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    serve(args.port, args.latency_ms / 1000, start_height=args.start, head_height=args.start + args.blocks,
+          txs_per_block=args.txs, erc20_ratio=args.erc20_ratio, hit_rate=args.hit_rate, addresses=args.addresses,
+          reorg_every=args.reorg_every, reorg_depth=args.reorg_depth, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,11 @@ from sign.rsa import RsaCrypto
 
 
 def check_passphrase(project_coin, secret) -> (bool, object, str, object):
-    private_key = project_coin.ProjectCoin.hot_pk
+    return check_hot_wallet(project_coin.ProjectCoin.hot_pk, project_coin.ProjectCoin.hot_address, secret)
+
+
+def check_hot_wallet(private_key, hot_address, secret) -> (bool, object, str, object):
+    """同 check_passphrase, 直接使用热钱包密钥及地址, 供读取项目缓存的任务使用"""
     if private_key is None:
         return False, ResponseObject.error(**sign_rsa_not_found), None, None
     crypto = RsaCrypto()
@@ -25,7 +29,7 @@ def check_passphrase(project_coin, secret) -> (bool, object, str, object):
     if rpc is None:
         return False, ResponseObject.error(**out_data_missing), None, None
 
-    is_correct_passphrase = rpc.open_wallet(passphrase=passphrase, address=project_coin.ProjectCoin.hot_address)
+    is_correct_passphrase = rpc.open_wallet(passphrase=passphrase, address=hot_address)
     if not is_correct_passphrase:
         return False, ResponseObject.error(**passphrase_invalid), None, None
     return True, crypto, passphrase, rpc
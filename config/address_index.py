@@ -0,0 +1,232 @@
+"""
+紧凑地址索引
+
+替代 {address: {"project_id", "coin_id", "coin_name"}} 形式的字典,
+地址统一转为 20 字节二进制按序存放在一块连续内存中, 项目 ID 与币种 ID 使用整型数组,
+币种名称驻留后只保存序号. 每个地址约占 30 字节.
+
+新增地址先进入一个小的增量字典, 增量超过阈值后合并进有序数组.
+对外保持与原字典相同的用法: in, get, [], update, items, len.
+"""
+from array import array
+from bisect import bisect_left
+
+KEY_SIZE = 20
+# 以地址前 2 个字节分桶, 缩小二分查找范围
+BUCKET_COUNT = 1 << 16
+
+
+def normalize(address):
+    """地址转为 20 字节二进制, 非法地址返回 None"""
+    if isinstance(address, bytes):
+        return address if len(address) == KEY_SIZE else None
+    if not isinstance(address, str):
+        return None
+    if address[:2] in ('0x', '0X'):
+        address = address[2:]
+    if len(address) != KEY_SIZE * 2:
+        return None
+    try:
+        return bytes.fromhex(address)
+    except ValueError:
+        return None
+
+
+def to_address(key):
+    return '0x' + key.hex()
+
+
+class _Keys(object):
+    """有序二进制地址的序列视图, 供 bisect 使用"""
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.keys) // KEY_SIZE
+
+    def __getitem__(self, idx):
+        return self.keys[idx * KEY_SIZE:(idx + 1) * KEY_SIZE]
+
+
+class AddressIndex(object):
+    """
+    地址索引
+    :param merge_threshold: 增量字典合并进有序数组的最小条数
+    """
+
+    def __init__(self, merge_threshold=4096):
+        self.merge_threshold = merge_threshold
+        # 驻留的币种名称
+        self._names = []
+        self._name_idx = {}
+        # 有序部分: (keys, project_ids, coin_ids, name_ids, buckets), 合并时整体替换
+        self._base = (b'', array('i'), array('i'), array('H'), array('I', bytes(4 * (BUCKET_COUNT + 1))))
+        # 增量部分: dict<key, tuple<project_id, coin_id, name_id>>
+        self._delta = {}
+        # 已从数据库同步到的最大地址 ID 及同步时间, 用于增量同步
+        self.last_id = 0
+        self.synced_at = 0
+
+    def _intern(self, coin_name):
+        idx = self._name_idx.get(coin_name)
+        if idx is None:
+            idx = len(self._names)
+            self._names.append(coin_name)
+            self._name_idx[coin_name] = idx
+        return idx
+
+    def _find(self, key, base=None):
+        """有序部分中的位置, 不存在返回 -1"""
+        keys, _, _, _, buckets = base or self._base
+        if not keys:
+            return -1
+        bucket = (key[0] << 8) | key[1]
+        lo, hi = buckets[bucket], buckets[bucket + 1]
+        if lo == hi:
+            return -1
+        idx = bisect_left(_Keys(keys), key, lo, hi)
+        if idx < hi and keys[idx * KEY_SIZE:(idx + 1) * KEY_SIZE] == key:
+            return idx
+        return -1
+
+    def _row(self, key):
+        row = self._delta.get(key)
+        if row is not None:
+            return row
+        base = self._base
+        idx = self._find(key, base)
+        if idx < 0:
+            return None
+        return base[1][idx], base[2][idx], base[3][idx]
+
+    def _info(self, row):
+        return {"project_id": row[0], "coin_id": row[1], "coin_name": self._names[row[2]]}
+
+    def __contains__(self, address):
+        key = normalize(address)
+        return key is not None and self._row(key) is not None
+
+    def __len__(self):
+        base_keys = self._base[0]
+        return len(base_keys) // KEY_SIZE + sum(1 for key in self._delta if self._find(key) < 0)
+
+    def get(self, address, default=None):
+        key = normalize(address)
+        if key is None:
+            return default
+        row = self._row(key)
+        if row is None:
+            return default
+        return self._info(row)
+
+    def __getitem__(self, address):
+        info = self.get(address)
+        if info is None:
+            raise KeyError(address)
+        return info
+
+    def add(self, address, project_id, coin_id, coin_name):
+        key = normalize(address)
+        if key is None:
+            raise ValueError('地址格式错误: {}'.format(address))
+        self._delta[key] = (project_id, coin_id, self._intern(coin_name))
+        self.maybe_merge()
+
+    def __setitem__(self, address, info):
+        self.add(address, info['project_id'], info['coin_id'], info['coin_name'])
+
+    def update(self, addresses):
+        """批量添加, addresses: dict<address, info> 或 iterable<tuple<address, info>>"""
+        items = addresses.items() if hasattr(addresses, 'items') else addresses
+        for address, info in items:
+            key = normalize(address)
+            if key is None:
+                raise ValueError('地址格式错误: {}'.format(address))
+            self._delta[key] = (info['project_id'], info['coin_id'], self._intern(info['coin_name']))
+        self.maybe_merge()
+
+    def load(self, rows, merge=True):
+        """
+        从查询结果批量加载
+        :param rows: iterable<tuple<address, project_id, coin_id, coin_name>>
+        :param merge: 是否加载完成后立即合并, 分页加载时可在最后一页后再合并
+        """
+        for address, project_id, coin_id, coin_name in rows:
+            key = normalize(address)
+            if key is None:
+                continue
+            self._delta[key] = (project_id, coin_id, self._intern(coin_name))
+        if merge:
+            self.merge()
+
+    def maybe_merge(self):
+        """增量部分超过阈值时合并"""
+        if len(self._delta) >= max(self.merge_threshold, len(self._base[1]) // 8):
+            self.merge()
+
+    def merge(self):
+        """将增量部分合并进有序数组"""
+        if not self._delta:
+            return
+        delta = self._delta
+        keys, project_ids, coin_ids, name_ids, _ = self._base
+        # 已存在的地址就地更新
+        new_keys = []
+        for key, row in delta.items():
+            idx = self._find(key)
+            if idx >= 0:
+                project_ids[idx], coin_ids[idx], name_ids[idx] = row
+            else:
+                new_keys.append(key)
+        new_keys.sort()
+
+        # 两个有序序列归并
+        old = _Keys(keys)
+        merged_keys = bytearray()
+        merged_pids, merged_cids, merged_nids = array('i'), array('i'), array('H')
+        i, n = 0, len(old)
+        for key in new_keys:
+            j = bisect_left(old, key, i, n)
+            merged_keys += keys[i * KEY_SIZE:j * KEY_SIZE]
+            merged_pids.extend(project_ids[i:j])
+            merged_cids.extend(coin_ids[i:j])
+            merged_nids.extend(name_ids[i:j])
+            row = delta[key]
+            merged_keys += key
+            merged_pids.append(row[0])
+            merged_cids.append(row[1])
+            merged_nids.append(row[2])
+            i = j
+        merged_keys += keys[i * KEY_SIZE:]
+        merged_pids.extend(project_ids[i:])
+        merged_cids.extend(coin_ids[i:])
+        merged_nids.extend(name_ids[i:])
+
+        merged_keys = bytes(merged_keys)
+        buckets = array('I', bytes(4 * (BUCKET_COUNT + 1)))
+        for idx in range(0, len(merged_keys), KEY_SIZE):
+            buckets[((merged_keys[idx] << 8) | merged_keys[idx + 1]) + 1] += 1
+        for b in range(BUCKET_COUNT):
+            buckets[b + 1] += buckets[b]
+
+        self._base = (merged_keys, merged_pids, merged_cids, merged_nids, buckets)
+        self._delta = {}
+
+    def items(self):
+        """(address, info) 迭代, 增量部分在后"""
+        keys, project_ids, coin_ids, name_ids, _ = self._base
+        delta = dict(self._delta)
+        for idx in range(len(project_ids)):
+            key = keys[idx * KEY_SIZE:(idx + 1) * KEY_SIZE]
+            row = delta.pop(key, None) or (project_ids[idx], coin_ids[idx], name_ids[idx])
+            yield to_address(key), self._info(row)
+        for key, row in delta.items():
+            yield to_address(key), self._info(row)
+
+    def keys(self):
+        for address, _ in self.items():
+            yield address
+
+    def __iter__(self):
+        return self.keys()
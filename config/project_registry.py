@@ -0,0 +1,118 @@
+"""
+项目缓存
+
+进程内缓存项目及项目币种, 按 update_time 增量刷新, 上账、归集、打手续费直接读取内存.
+增量刷新只能发现新增及修改, 定期全量重新加载以淘汰已删除的记录.
+项目部分保持与原字典相同的用法: in, get, [], items, len.
+项目币种的热钱包密钥未变化且密码未重新设置时, 复用已校验的钱包密码, 不再重复解密及解锁校验.
+"""
+
+
+class ProjectRegistry(object):
+    """项目及项目币种缓存"""
+
+    def __init__(self):
+        # {project_id: {"name", "url", "access_key", "secret_key"}}
+        self.projects = {}
+        # {(project_id, coin_name): {"id", "coin_id", "hot_address", "hot_pk", "cold_address", "fee_address",
+        #                            "gas", "gas_price"}}
+        self.project_coins = {}
+        # {(project_id, coin_name): (secret, passphrase)}
+        self._passphrases = {}
+        # 已同步的最大 update_time
+        self.project_updated = None
+        self.coin_updated = None
+        self.synced_at = 0
+        self.reloaded_at = 0
+
+    def __contains__(self, project_id):
+        return project_id in self.projects
+
+    def __getitem__(self, project_id):
+        return self.projects[project_id]
+
+    def __len__(self):
+        return len(self.projects)
+
+    def get(self, project_id, default=None):
+        return self.projects.get(project_id, default)
+
+    def items(self):
+        return list(self.projects.items())
+
+    def load_projects(self, rows, full=False):
+        """
+        :param rows: iterable<row>, 含 id, name, callback_url, access_key, secret_key, update_time
+        :param full: rows 为全部项目, 不在其中的项目被淘汰
+        :return: 新增、变化及淘汰的数量
+        """
+        changed = 0
+        seen = set()
+        for row in rows:
+            seen.add(row.id)
+            project = {
+                "name": row.name,
+                "url": row.callback_url,
+                "access_key": row.access_key,
+                "secret_key": row.secret_key,
+            }
+            if self.projects.get(row.id) != project:
+                self.projects[row.id] = project
+                changed += 1
+            if self.project_updated is None or row.update_time > self.project_updated:
+                self.project_updated = row.update_time
+        if full:
+            for project_id in set(self.projects) - seen:
+                del self.projects[project_id]
+                changed += 1
+        return changed
+
+    def load_project_coins(self, rows, full=False):
+        """
+        热钱包地址或密钥变化时清除已校验的密码
+        :param rows: iterable<row>, 含 project_id, coin_name 及 project_coins 中的字段, update_time
+        :param full: rows 为全部项目币种, 不在其中的项目币种被淘汰, 同时清除其已校验的密码
+        :return: 新增、变化及淘汰的数量
+        """
+        changed = 0
+        seen = set()
+        for row in rows:
+            key = (row.project_id, row.coin_name)
+            seen.add(key)
+            project_coin = {
+                "id": row.id,
+                "coin_id": row.coin_id,
+                "hot_address": row.hot_address,
+                "hot_pk": row.hot_pk,
+                "cold_address": row.cold_address,
+                "fee_address": row.fee_address,
+                "gas": row.gas,
+                "gas_price": row.gas_price,
+            }
+            old = self.project_coins.get(key)
+            if old != project_coin:
+                if old is None or (old['hot_address'], old['hot_pk']) != (row.hot_address, row.hot_pk):
+                    self._passphrases.pop(key, None)
+                self.project_coins[key] = project_coin
+                changed += 1
+            if self.coin_updated is None or row.update_time > self.coin_updated:
+                self.coin_updated = row.update_time
+        if full:
+            for key in set(self.project_coins) - seen:
+                del self.project_coins[key]
+                self._passphrases.pop(key, None)
+                changed += 1
+        return changed
+
+    def get_project_coin(self, project_id, coin_name):
+        return self.project_coins.get((project_id, coin_name))
+
+    def get_passphrase(self, project_id, coin_name, secret):
+        """已校验的钱包密码, 密码重新设置过或未校验时返回 None"""
+        cached = self._passphrases.get((project_id, coin_name))
+        if cached is None or cached[0] != secret:
+            return None
+        return cached[1]
+
+    def set_passphrase(self, project_id, coin_name, secret, passphrase):
+        self._passphrases[(project_id, coin_name)] = (secret, passphrase)
@@ -1,3 +1,5 @@
+from config.address_index import AddressIndex
+from config.project_registry import ProjectRegistry
 from config.config import CONFIG
 
 """
@@ -17,7 +19,7 @@ rsa_secret = {}
 app = None
 
 """
-此处结构为：
+此处结构为 AddressIndex, 用法同字典：
 {
     address: {
         "project_id": project_id,
@@ -25,8 +27,9 @@ app = None
         "coin_name": coin_name
     }
 }
+地址统一为小写, 查找时不区分大小写
 """
-project_address = {}
+project_address = AddressIndex()
 
 """
 此处结构为：
@@ -43,7 +46,7 @@ project_address = {}
 coins = {}
 
 """
-此处结构为：
+此处结构为 ProjectRegistry, 项目部分用法同字典：
 {
     project_id: {
         "name": name,
@@ -52,6 +55,7 @@ coins = {}
         "secret_key": secret_key,
     }
 }
+项目币种通过 get_project_coin(project_id, coin_name) 读取
 """
-project = {}
+project = ProjectRegistry()
 
@@ -6,9 +6,17 @@ from sign.sign import sign_data
 from code_status import (sign_error, sign_timeout, sign_require, sign_msg_error,
                          sign_key_invalid)
 
+# 不参与签名的字段
+SIGN_EXCLUDE = ['signsture', 'accessKey']
+
+
+def order_data(data, exclude=SIGN_EXCLUDE):
+    """签名原文: 按键排序拼接 key=value, 接口验签与项目批量回调签名共用"""
+    return '&'.join(['{}={}'.format(key, data[key]) for key in sorted(data) if key not in exclude])
+
 
 class Auth(object):
-    __EXCLUDE = ['signsture', 'accessKey']
+    __EXCLUDE = SIGN_EXCLUDE
     __SIGN_REQUIRE = __EXCLUDE + ['timestamp']
     TIMEOUT_SECONDS = 60 * 5 * 1000000
 
@@ -34,9 +42,7 @@ class Auth(object):
         return data
 
     def order_data(self):
-        keys_order = sorted(self.data)
-        data = '&'.join(['{}={}'.format(key, self.data[key]) for key in keys_order if key not in self.__EXCLUDE])
-        return data
+        return order_data(self.data, self.__EXCLUDE)
 
     def check_time(self):
         local_time = time.time()
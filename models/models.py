@@ -1,14 +1,16 @@
 """
 db 表
 """
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta
 
 from coin.driver.driver_base import DriverFactory
-from dt import now
-from enumer.coin_enum import SendEnum
+from enumer.coin_enum import SendEnum, TxTypeEnum
 from flask_sqlalchemy import orm
 from httplibs.coinrpc.rpcbase import RpcBase
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, case, exists, func, literal
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.mysql import insert
 
 from exts import db
 
@@ -59,6 +61,46 @@ class Block(db.Model):
         return "{id}-{height}-{block_hash}".format(
             id=self.id, height=self.height, block_hash=self.block_hash)
 
+    @classmethod
+    def add_blocks_or_update(cls, blocks: list, *, commit=True, session=None):
+        """
+        多行一次写入块, 高度已存在时更新 hash 及时间
+        :param blocks: list<dict>, [{height, block_hash, block_time}]
+        :return: dict<height, block_id>
+        """
+        session = session or db.session()
+        if not blocks:
+            return {}
+        create_time = datetime.now()
+        rows = [dict(block, create_time=create_time) for block in blocks]
+        stmt = insert(cls.__table__).values(rows)
+        stmt = stmt.on_duplicate_key_update(block_hash=stmt.inserted.block_hash,
+                                            block_time=stmt.inserted.block_time)
+        session.execute(stmt)
+        heights = [block['height'] for block in blocks]
+        block_ids = dict(session.query(cls.height, cls.id).filter(
+            cls.height.between(min(heights), max(heights))).all())
+        if commit:
+            session.commit()
+        return block_ids
+
+    @classmethod
+    def get_recent_hashes(cls, height, limit):
+        """获取高度 height 以下(不含)最近 limit 个块的 (height, block_hash), 按高度升序"""
+        session = db.session()
+        rows = session.query(cls.height, cls.block_hash).filter(
+            cls.height < height).order_by(cls.height.desc()).limit(limit).all()
+        return list(reversed(rows))
+
+    @classmethod
+    def delete_from_height(cls, height, end_height=None, *, session=None):
+        """删除高度 >= height (且 < end_height) 的块, 重组回滚使用"""
+        session = session or db.session()
+        query = session.query(cls).filter(cls.height >= height)
+        if end_height is not None:
+            query = query.filter(cls.height < end_height)
+        return query.delete(synchronize_session=False)
+
 
 class Coin(db.Model):
     """
@@ -242,6 +284,19 @@ class Address(db.Model):
         ).filter(Coin.name == coin_name).all()
         return addresses
 
+    @staticmethod
+    def get_coin_address_after_id(coin_name, last_id, limit=10000):
+        """
+        增量获取 id > last_id 的地址, 按 id 升序
+        :return list<tuple<id, address, project_id, coin_id, coin_name>>
+        """
+        session = db.session()
+        addresses = session.query(Address, Coin).join(
+            Address, Address.coin_id == Coin.id).with_entities(
+            Address.id, Address.address, Address.project_id, Address.coin_id, Coin.name
+        ).filter(Coin.name == coin_name, Address.id > last_id).order_by(Address.id).limit(limit).all()
+        return addresses
+
 
 class Transaction(db.Model):
     """
@@ -250,8 +305,17 @@ class Transaction(db.Model):
     __tablename__ = 'tx'
     __table_args__ = (
         UniqueConstraint('tx_hash', 'coin_id', name='uk_tx_hash_coin_id'),
+        # 按 id 分页查询待推送交易
+        db.Index('ix_is_send_id', 'is_send', 'id'),
+        db.Index('ix_seen_send_id', 'seen_send', 'id'),
         {'mysql_engine': "INNODB"}
     )
+    # 确认状态, 扫描到最新块时充值先以未确认入库
+    UNCONFIRMED = 0
+    CONFIRMED = 1
+    DROPPED = 2
+    # is_send 及 seen_send 的取值, 通知已进入死信, 补漏不再扫描, 死信重新入队时恢复为未推
+    SEND_DEAD = 3
 
     id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
     block_id = db.Column(db.Integer, nullable=False, comment="块表关联键", index=True)
@@ -268,7 +332,12 @@ class Transaction(db.Model):
     contract = db.Column(db.VARCHAR(128), comment="代币名称或地址")
     status = db.Column(db.SmallInteger, nullable=False, comment="交易是否有效 1）有效 0）无效 2) 未知")
     type = db.Column(db.SmallInteger, nullable=False, comment="交易类型")
-    is_send = db.Column(db.SmallInteger, nullable=False, comment="是否推送 0:未推 1:已推 2:不用推")
+    is_send = db.Column(db.SmallInteger, nullable=False, comment="是否推送 0:未推 1:已推 2:不用推 3:死信")
+    block_hash = db.Column(db.VARCHAR(128), comment="交易所在块hash")
+    confirm_status = db.Column(db.SmallInteger, nullable=False, default=1, server_default='1', index=True,
+                               comment="确认状态 0:未确认 1:已确认 2:已被重组丢弃")
+    seen_send = db.Column(db.SmallInteger, nullable=False, default=2, server_default='2',
+                          comment="未确认(及丢弃)通知是否推送 0:未推 1:已推 2:不用推 3:死信")
     create_time = db.Column(db.DateTime, nullable=False, comment="创建时间", default=datetime.now)
     update_time = db.Column(db.DateTime, nullable=False, comment="更新时间",
                             default=datetime.now, onupdate=datetime.now)
@@ -310,6 +379,94 @@ class Transaction(db.Model):
             Transaction.tx_hash == tx_hash)
         return txs.first()
 
+    @classmethod
+    def delete_deposit_from_height(cls, height, end_height=None, *, session=None):
+        """
+        删除高度 >= height (且 < end_height) 的充值交易, 重组回滚使用
+        :return: (删除数量, 其中已推送数量)
+        """
+        session = session or db.session()
+        query = session.query(cls).filter(cls.height >= height, cls.type == TxTypeEnum.DEPOSIT.value,
+                                          cls.confirm_status == cls.CONFIRMED)
+        if end_height is not None:
+            query = query.filter(cls.height < end_height)
+        pushed = query.filter(cls.is_send == SendEnum.PUSHED.value).count()
+        deleted = query.delete(synchronize_session=False)
+        return deleted, pushed
+
+    @classmethod
+    def get_unconfirmed_deposits(cls, below_height):
+        """
+        高度 < below_height 的未确认充值
+        :return: list<tuple<id, height, block_hash>>
+        """
+        session = db.session()
+        return session.query(cls).with_entities(cls.id, cls.height, cls.block_hash).filter(
+            cls.confirm_status == cls.UNCONFIRMED, cls.type == TxTypeEnum.DEPOSIT.value,
+            cls.height < below_height).all()
+
+    @classmethod
+    def confirm_deposits(cls, tx_ids, *, commit=True, session=None):
+        """未确认充值达到确认数, 尚未推送的未确认通知不再推送"""
+        session = session or db.session()
+        if not tx_ids:
+            return 0
+        updated = session.query(cls).filter(cls.id.in_(tx_ids), cls.confirm_status == cls.UNCONFIRMED).update(
+            {'confirm_status': cls.CONFIRMED,
+             'seen_send': case([(cls.seen_send == SendEnum.NOT_PUSH.value, SendEnum.NEEDLESS.value)],
+                               else_=cls.seen_send)},
+            synchronize_session=False)
+        if commit:
+            session.commit()
+        return updated
+
+    @classmethod
+    def drop_deposits(cls, tx_ids=None, height=None, *, commit=True, session=None):
+        """
+        所在块被重组的未确认充值标记为丢弃, 不会再推送确认通知.
+        已推送过未确认通知的重新置为未推, 以推送丢弃通知
+        :param tx_ids: 按 ID 丢弃
+        :param height: 丢弃高度 >= height 的全部未确认充值
+        """
+        session = session or db.session()
+        query = session.query(cls).filter(cls.confirm_status == cls.UNCONFIRMED, cls.type == TxTypeEnum.DEPOSIT.value)
+        if tx_ids is not None:
+            if not tx_ids:
+                return 0
+            query = query.filter(cls.id.in_(tx_ids))
+        if height is not None:
+            query = query.filter(cls.height >= height)
+        updated = query.update(
+            {'confirm_status': cls.DROPPED,
+             'seen_send': case([(cls.seen_send == SendEnum.PUSHED.value, SendEnum.NOT_PUSH.value)],
+                               else_=SendEnum.NEEDLESS.value)},
+            synchronize_session=False)
+        if commit:
+            session.commit()
+        return updated
+
+    @classmethod
+    def max_id(cls):
+        return db.session().query(func.max(cls.id)).scalar() or 0
+
+    @classmethod
+    def mark_pushed(cls, tx_ids, send_field='is_send', confirm_status=None, *, commit=True, session=None):
+        """
+        批量置为已推送, 一次 UPDATE ... WHERE id IN
+        :param send_field: is_send 或 seen_send
+        :param confirm_status: 推送时的确认状态, 推送期间状态已变化的不更新, 留给下次按新状态推送
+        """
+        session = session or db.session()
+        if not tx_ids:
+            return 0
+        query = session.query(cls).filter(cls.id.in_(tx_ids))
+        if confirm_status is not None:
+            query = query.filter(cls.confirm_status == confirm_status)
+        updated = query.update({send_field: SendEnum.PUSHED.value}, synchronize_session=False)
+        if commit:
+            session.commit()
+        return updated
+
     @classmethod
     def add_transaction(cls, coin_id, tx_hash, block_time, sender, receiver, amount, status,
                         tx_type, block_id, height, gas=0, gas_price=0, fee=0,
@@ -336,40 +493,52 @@ class Transaction(db.Model):
                                   status, tx_type, block_id, height, gas=0, gas_price=0, fee=0,
                                   contract=None, is_send=0, *, commit=True, session=None):
         """添加交易或更新交易"""
-        session = session or db.session()
+        return cls.add_transactions_or_update(
+            [dict(coin_id=coin_id, tx_hash=tx_hash, block_time=block_time, sender=sender,
+                  receiver=receiver, amount=amount, status=status, tx_type=tx_type,
+                  block_id=block_id, height=height, gas=gas, gas_price=gas_price, fee=fee,
+                  contract=contract, is_send=is_send)],
+            commit=commit, session=session)
 
-        sql = (
-            "insert into {table_name} (coin_id, tx_hash, block_time, sender, receiver, amount, "
-            "status, type, gas, gas_price, fee, contract, block_id, height, is_send, "
-            "create_time, update_time) "
-            "values "
-            "({coin_id}, '{tx_hash}', {block_time}, '{sender}', '{receiver}', {amount}, {status}, "
-            "{type}, {gas}, {gas_price}, {fee}, {contract}, {block_id}, {height}, {is_send}, "
-            "'{create_time}', '{update_time}')"
-            "ON DUPLICATE KEY UPDATE block_time=values(block_time), gas=values(gas), "
-            "gas_price=values(gas_price), "
-            "fee=values(fee), block_id=values(block_id), height=values(height)").format(
-            table_name=cls.__tablename__,
-            coin_id=coin_id,
-            tx_hash=tx_hash,
-            block_time=block_time,
-            sender=sender,
-            receiver=receiver,
-            amount=amount,
-            status=status,
-            type=tx_type,
-            gas=gas,
-            gas_price=gas_price,
-            fee=fee,
-            contract="'{}'".format(contract) if contract is not None else 'null',
-            block_id=block_id,
-            height=height,
-            is_send=is_send,
-            create_time=now(),
-            update_time=now())
+    @classmethod
+    def add_transactions_or_update(cls, txs: list, *, commit=True, session=None):
+        """
+        多行一次添加或更新交易, 全部使用绑定参数
+        :param txs: list<dict>, 字段同 add_transaction_or_update 入参, 另可包含 block_hash, confirm_status, seen_send
+        :return: 同 add_transaction_or_update
+        """
+        session = session or db.session()
+        if not txs:
+            return None if commit else session
+        update_time = datetime.now()
+        rows = []
+        for tx in txs:
+            row = dict(tx)
+            row['type'] = row.pop('tx_type')
+            row.setdefault('gas', 0)
+            row.setdefault('gas_price', 0)
+            row.setdefault('fee', 0)
+            row.setdefault('contract', None)
+            row.setdefault('is_send', 0)
+            row.setdefault('block_hash', None)
+            row.setdefault('confirm_status', cls.CONFIRMED)
+            row.setdefault('seen_send', SendEnum.NEEDLESS.value)
+            row['create_time'] = row['update_time'] = update_time
+            rows.append(row)
+
+        stmt = insert(cls.__table__).values(rows)
+        stmt = stmt.on_duplicate_key_update(
+            block_time=stmt.inserted.block_time, gas=stmt.inserted.gas,
+            gas_price=stmt.inserted.gas_price, fee=stmt.inserted.fee,
+            block_id=stmt.inserted.block_id, height=stmt.inserted.height,
+            block_hash=stmt.inserted.block_hash,
+            # 已确认的不再回到未确认, 如扫描到最新块时重复扫描已确认的高度
+            confirm_status=case([(cls.confirm_status == cls.CONFIRMED, cls.confirm_status)],
+                                else_=stmt.inserted.confirm_status),
+            update_time=stmt.inserted.update_time)
 
         # saved 如果成功情况下是 None
-        saved = session.execute(sql)
+        saved = session.execute(stmt)
         if commit:
             # 自动提交
             session.commit()
@@ -402,10 +571,15 @@ class RpcConfig(db.Model):
         return "{id}-{coin_id}-{name}-{driver}-{host}".format(
             id=self.id, coin_id=self.coin_id, name=self.name, driver=self.driver, host=self.host)
 
+    @staticmethod
+    def get_rpc_config():
+        """获取当前启用的 RPC 配置"""
+        return RpcConfig.query.filter_by(driver='Ethereum', status=1).first()
+
     @staticmethod
     def get_rpc() -> RpcBase:
         """获取rpc, 返回RPC对象"""
-        rpc_config = RpcConfig.query.filter_by(driver='Ethereum', status=1).first()
+        rpc_config = RpcConfig.get_rpc_config()
         if not rpc_config:
             return None
         driver = rpc_config.driver
@@ -441,6 +615,16 @@ class Project(db.Model):
         return "{id}-{name}-{access_key}-{callback_url}".format(
             id=self.id, name=self.name, access_key=self.access_key, callback_url=self.callback_url)
 
+    @staticmethod
+    def get_projects_updated_since(update_time=None):
+        """update_time 不早于指定时间的项目, 未指定时返回全部"""
+        session = db.session()
+        query = session.query(Project.id, Project.name, Project.callback_url, Project.access_key,
+                              Project.secret_key, Project.update_time)
+        if update_time is not None:
+            query = query.filter(Project.update_time >= update_time)
+        return query.all()
+
 
 class ProjectCoin(db.Model):
     """项目方支持的币种"""
@@ -497,6 +681,19 @@ class ProjectCoin(db.Model):
             Coin.name == coin_name)
         return project_coin.first()
 
+    @staticmethod
+    def get_pro_coins_updated_since(update_time=None):
+        """update_time 不早于指定时间的项目币种及币种名称, 未指定时返回全部"""
+        session = db.session()
+        query = session.query(
+            ProjectCoin.id, ProjectCoin.project_id, ProjectCoin.coin_id, Coin.name.label('coin_name'),
+            ProjectCoin.hot_address, ProjectCoin.hot_pk, ProjectCoin.cold_address, ProjectCoin.fee_address,
+            ProjectCoin.gas, ProjectCoin.gas_price, ProjectCoin.update_time
+        ).join(Coin, ProjectCoin.coin_id == Coin.id)
+        if update_time is not None:
+            query = query.filter(ProjectCoin.update_time >= update_time)
+        return query.all()
+
 
 class ProjectOrder(db.Model):
     """项目方订单"""
@@ -628,6 +825,368 @@ class SyncConfig(db.Model):
         return coin_sync
 
 
+class ScanLease(db.Model):
+    """扫链高度区间租约, 多个扫链进程各自租用互不重叠的区间"""
+    __tablename__ = 'scan_lease'
+    __table_args__ = (
+        UniqueConstraint('coin_id', 'start_height', name='uk_coin_id_start_height'),
+        {'mysql_engine': "INNODB"}
+    )
+    LEASED = 0
+    DONE = 1
+
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    coin_id = db.Column(db.Integer, nullable=False, comment="主链币 ID")
+    start_height = db.Column(db.Integer, nullable=False, comment="起始高度, 包含")
+    end_height = db.Column(db.Integer, nullable=False, comment="结束高度, 不包含")
+    scanned_height = db.Column(db.Integer, nullable=False, comment="区间内已同步高度")
+    worker = db.Column(db.VARCHAR(128), nullable=False, comment="租用者")
+    status = db.Column(db.SmallInteger, nullable=False, default=0, comment="0:租用中 1:已完成")
+    lease_expire = db.Column(db.DateTime, nullable=False, index=True, comment="租约到期时间")
+    create_time = db.Column(db.DateTime, nullable=False, comment="创建时间", default=datetime.now)
+    update_time = db.Column(db.DateTime, nullable=False, comment="更新时间",
+                            default=datetime.now, onupdate=datetime.now)
+
+    def __str__(self):
+        return "{id}-{coin_id}-{start_height}-{end_height}-{worker}-{status}".format(
+            id=self.id, coin_id=self.coin_id, start_height=self.start_height,
+            end_height=self.end_height, worker=self.worker, status=self.status)
+
+    @classmethod
+    def acquire(cls, coin_id, worker, base_height, max_height, size, ttl):
+        """
+        租用一个区间, 优先接手已过期的租约, 否则在最高区间之后新建租约
+        :param base_height: 没有任何租约时的起始高度, 即 SyncConfig.synced_height
+        :param max_height: 可扫描的最高高度, 不包含
+        :param size: 区间大小
+        :param ttl: 租约有效秒数
+        :return: ScanLease or None
+        """
+        session = db.session()
+        expire = datetime.now() + timedelta(seconds=ttl)
+        lease = session.query(cls).filter(
+            cls.coin_id == coin_id, cls.status == cls.LEASED, cls.lease_expire < datetime.now()
+        ).order_by(cls.start_height).with_for_update(skip_locked=True).first()
+        if lease:
+            lease.worker, lease.lease_expire = worker, expire
+            session.commit()
+            return lease
+        session.commit()
+
+        for _ in range(5):
+            highest = session.query(func.max(cls.end_height)).filter(cls.coin_id == coin_id).scalar()
+            start = max(highest or 0, base_height)
+            if start >= max_height:
+                return None
+            lease = cls(coin_id=coin_id, start_height=start, end_height=min(start + size, max_height),
+                        scanned_height=start, worker=worker, status=cls.LEASED, lease_expire=expire)
+            session.add(lease)
+            try:
+                session.commit()
+                return lease
+            except IntegrityError:
+                # 其他进程已租用该区间
+                session.rollback()
+        return None
+
+    @classmethod
+    def heartbeat(cls, lease_id, worker, scanned_height, ttl, *, session=None):
+        """记录区间内进度并续租, 租约已被他人接手时返回 False"""
+        session = session or db.session()
+        updated = session.query(cls).filter(cls.id == lease_id, cls.worker == worker).update(
+            {'scanned_height': scanned_height,
+             'lease_expire': datetime.now() + timedelta(seconds=ttl)}, synchronize_session=False)
+        return bool(updated)
+
+    @classmethod
+    def complete(cls, lease_id, worker):
+        session = db.session()
+        session.query(cls).filter(cls.id == lease_id, cls.worker == worker).update(
+            {'status': cls.DONE}, synchronize_session=False)
+        session.commit()
+
+    @classmethod
+    def abandon(cls, lease_id, worker):
+        """放弃租约, 清理区间内已写入的数据, 立即可被重新租用"""
+        session = db.session()
+        try:
+            lease = session.query(cls).filter(cls.id == lease_id, cls.worker == worker).with_for_update().first()
+            if lease:
+                Block.delete_from_height(lease.start_height, lease.end_height, session=session)
+                Transaction.delete_deposit_from_height(lease.start_height, lease.end_height, session=session)
+                lease.scanned_height = lease.start_height
+                lease.lease_expire = datetime.now()
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    @classmethod
+    def release(cls, lease_id, worker):
+        """释放租约, 保留区间内进度, 立即可被重新租用"""
+        session = db.session()
+        session.query(cls).filter(cls.id == lease_id, cls.worker == worker).update(
+            {'lease_expire': datetime.now()}, synchronize_session=False)
+        session.commit()
+
+    @classmethod
+    def rewind(cls, coin_id, height, *, session=None):
+        """
+        重组回滚至 height 时删除结束高度在其之上的租约, 区间由之后的租约重新扫描.
+        正在扫描这些区间的进程续租失败后退出
+        """
+        session = session or db.session()
+        return session.query(cls).filter(cls.coin_id == coin_id, cls.end_height > height).delete(
+            synchronize_session=False)
+
+    @classmethod
+    def advance_watermark(cls, coin_id, sync_config_id):
+        """
+        将连续完成的租约合并进 SyncConfig.synced_height, 返回合并后的安全高度.
+        安全高度以下的块全部已入库.
+        """
+        session = db.session()
+        try:
+            sync = session.query(SyncConfig).filter(SyncConfig.id == sync_config_id).with_for_update().first()
+            watermark = sync.synced_height
+            leases = session.query(cls).filter(
+                cls.coin_id == coin_id, cls.end_height > watermark).order_by(cls.start_height).all()
+            done = []
+            for lease in leases:
+                if lease.start_height > watermark or lease.status != cls.DONE:
+                    break
+                watermark = lease.end_height
+                done.append(lease.id)
+            if done:
+                session.query(cls).filter(cls.id.in_(done)).delete(synchronize_session=False)
+                sync.synced_height = watermark
+            session.commit()
+            return watermark
+        except Exception:
+            session.rollback()
+            raise
+
+
+# 待推送通知及交易只查询用到的列
+DueNotify = namedtuple('DueNotify', ['id', 'tx_id', 'event', 'attempts'])
+DueTx = namedtuple('DueTx', ['id', 'tx_hash', 'height', 'amount', 'receiver', 'coin_id', 'confirm_status',
+                             'is_send', 'seen_send'])
+
+
+class NotifyQueue(db.Model):
+    """
+    项目回调队列, 每笔充值的每种通知一条.
+    推送失败按指数退避重试, 超过最大次数进入死信状态, 每次上账只处理已到期的通知
+    """
+    __tablename__ = 'notify_queue'
+    __table_args__ = (
+        UniqueConstraint('tx_id', 'event', name='uk_tx_id_event'),
+        db.Index('ix_status_next_attempt_at', 'status', 'next_attempt_at'),
+        db.Index('ix_status_id', 'status', 'id'),
+        {'mysql_engine': "INNODB"}
+    )
+    # 分页查询每页最多数量
+    MAX_PAGE_SIZE = 5000
+    PENDING = 0
+    DONE = 1
+    DEAD = 2
+    # 通知类型, 与 Transaction 确认状态对应
+    EVENT_SEEN = Transaction.UNCONFIRMED
+    EVENT_CONFIRMED = Transaction.CONFIRMED
+    EVENT_DROPPED = Transaction.DROPPED
+    EVENT_NAMES = {EVENT_SEEN: 'seen', EVENT_CONFIRMED: 'confirmed', EVENT_DROPPED: 'dropped'}
+    # 推送成功后置为已推的 Transaction 字段
+    EVENT_SEND_FIELDS = {EVENT_SEEN: 'seen_send', EVENT_CONFIRMED: 'is_send', EVENT_DROPPED: 'seen_send'}
+
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    tx_id = db.Column(db.BigInteger, nullable=False, comment="交易表关联键")
+    event = db.Column(db.SmallInteger, nullable=False, comment="通知类型 0:未确认 1:已确认 2:已被重组丢弃")
+    status = db.Column(db.SmallInteger, nullable=False, default=0, comment="0:待推送 1:已完成 2:死信")
+    attempts = db.Column(db.Integer, nullable=False, default=0, comment="已推送次数")
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.now, comment="下次推送时间")
+    last_error = db.Column(db.VARCHAR(512), comment="最近一次推送错误")
+    create_time = db.Column(db.DateTime, nullable=False, comment="创建时间", default=datetime.now)
+    update_time = db.Column(db.DateTime, nullable=False, comment="更新时间",
+                            default=datetime.now, onupdate=datetime.now)
+
+    def __str__(self):
+        return "{id}-{tx_id}-{event}-{status}-{attempts}".format(
+            id=self.id, tx_id=self.tx_id, event=self.event, status=self.status, attempts=self.attempts)
+
+    @classmethod
+    def enqueue_pending(cls, tx_ids=None, min_height=None, max_height=None, after_id=0, page_size=1000, *,
+                        session=None):
+        """
+        未推送的充值加入队列, 已在队列中(含死信)的不再查出.
+        扫链在写入交易的同一事务中按高度区间调用, 不指定范围时全表补漏.
+        待推送交易按 id 分页, 每页只取 id, 再以 INSERT IGNORE ... SELECT 写入
+        :param tx_ids: 只处理这些交易
+        :param min_height: 只处理高度 >= min_height 的交易
+        :param max_height: 只处理高度 <= max_height 的交易
+        :param after_id: 只处理 id > after_id 的交易
+        :param page_size: 每页数量, 不超过 MAX_PAGE_SIZE
+        :return: 新加入数量
+        """
+        session = session or db.session()
+        page_size = min(max(page_size, 1), cls.MAX_PAGE_SIZE)
+        scope = []
+        if tx_ids is not None:
+            if not tx_ids:
+                return 0
+            scope.append(Transaction.id.in_(tx_ids))
+        if min_height is not None:
+            scope.append(Transaction.height >= min_height)
+        if max_height is not None:
+            scope.append(Transaction.height <= max_height)
+        now = datetime.now()
+        count = 0
+        for event, condition in (
+                (cls.EVENT_CONFIRMED, (Transaction.is_send == SendEnum.NOT_PUSH.value,
+                                       Transaction.confirm_status == Transaction.CONFIRMED)),
+                (cls.EVENT_SEEN, (Transaction.seen_send == SendEnum.NOT_PUSH.value,
+                                  Transaction.confirm_status == Transaction.UNCONFIRMED)),
+                (cls.EVENT_DROPPED, (Transaction.seen_send == SendEnum.NOT_PUSH.value,
+                                     Transaction.confirm_status == Transaction.DROPPED))):
+            queued = exists().where(cls.tx_id == Transaction.id).where(cls.event == event)
+            last_id = after_id
+            while True:
+                ids = [tx_id for tx_id, in session.query(Transaction.id).filter(
+                    *condition, *scope, ~queued, Transaction.id > last_id).order_by(Transaction.id).limit(page_size)]
+                if not ids:
+                    break
+                rows = db.select([Transaction.id, literal(event), literal(cls.PENDING), literal(0),
+                                  literal(now), literal(now), literal(now)]).where(Transaction.id.in_(ids))
+                stmt = insert(cls.__table__).prefix_with('IGNORE').from_select(
+                    ['tx_id', 'event', 'status', 'attempts', 'next_attempt_at', 'create_time', 'update_time'], rows)
+                count += session.execute(stmt).rowcount
+                last_id = ids[-1]
+                if len(ids) < page_size:
+                    break
+        return count
+
+    @classmethod
+    def get_due(cls, limit=1000, after_id=0):
+        """
+        已到期的待推送通知, 按 id 分页, 只查询推送需要的列
+        :param limit: 每页数量, 不超过 MAX_PAGE_SIZE
+        :param after_id: 上一页最后一条通知的 id
+        :return: list<tuple<DueNotify, DueTx or None>>, 交易已被重组删除时为 None
+        """
+        session = db.session()
+        limit = min(max(limit, 1), cls.MAX_PAGE_SIZE)
+        rows = session.query(
+            cls.id, cls.tx_id, cls.event, cls.attempts,
+            Transaction.id.label('tx_pk'), Transaction.tx_hash, Transaction.height, Transaction.amount,
+            Transaction.receiver, Transaction.coin_id, Transaction.confirm_status, Transaction.is_send,
+            Transaction.seen_send
+        ).outerjoin(Transaction, Transaction.id == cls.tx_id).filter(
+            cls.status == cls.PENDING, cls.next_attempt_at <= datetime.now(), cls.id > after_id
+        ).order_by(cls.id).limit(limit)
+        return [(DueNotify(row.id, row.tx_id, row.event, row.attempts),
+                 None if row.tx_pk is None else DueTx(row.tx_pk, row.tx_hash, row.height, row.amount, row.receiver,
+                                                      row.coin_id, row.confirm_status, row.is_send, row.seen_send))
+                for row in rows]
+
+    @classmethod
+    def max_id(cls):
+        """队列最大 ID, 常驻上账以此判断是否有新通知"""
+        return db.session().query(func.max(cls.id)).scalar() or 0
+
+    @classmethod
+    def next_due_at(cls):
+        """最早到期的待推送时间, 没有待推送时为 None"""
+        return db.session().query(func.min(cls.next_attempt_at)).filter(cls.status == cls.PENDING).scalar()
+
+    @classmethod
+    def is_current(cls, event, tx):
+        """通知是否仍需推送, 入队后交易确认状态变化或已推送的不再推送"""
+        if tx is None or tx.confirm_status != event:
+            return False
+        return getattr(tx, cls.EVENT_SEND_FIELDS[event]) == SendEnum.NOT_PUSH.value
+
+    @classmethod
+    def mark_done(cls, ids, *, commit=True, session=None):
+        session = session or db.session()
+        if not ids:
+            return 0
+        updated = session.query(cls).filter(cls.id.in_(ids)).update(
+            {'status': cls.DONE, 'attempts': cls.attempts + 1, 'last_error': None}, synchronize_session=False)
+        if commit:
+            session.commit()
+        return updated
+
+    @classmethod
+    def mark_failed(cls, failures, max_attempts, retry_base, retry_max, *, commit=True, session=None):
+        """
+        推送失败, 按 retry_base * 2 ^ (attempts - 1) 秒退避, 最多 retry_max 秒, 达到 max_attempts 次进入死信.
+        进入死信的交易推送字段置为 SEND_DEAD, 补漏不再扫描
+        :param failures: list<tuple<NotifyQueue or DueNotify, error>>
+        :return: 进入死信的数量
+        """
+        session = session or db.session()
+        now = datetime.now()
+        groups = {}
+        dead_txs = {}
+        for item, error in failures:
+            groups.setdefault((item.attempts + 1, (error or '')[:512]), []).append(item.id)
+            if item.attempts + 1 >= max_attempts:
+                dead_txs.setdefault(item.event, []).append(item.tx_id)
+        dead = 0
+        for (attempts, error), ids in groups.items():
+            values = {'attempts': attempts, 'last_error': error}
+            if attempts >= max_attempts:
+                values['status'] = cls.DEAD
+                dead += len(ids)
+            else:
+                values['next_attempt_at'] = now + timedelta(seconds=min(retry_base * 2 ** (attempts - 1), retry_max))
+            session.query(cls).filter(cls.id.in_(ids)).update(values, synchronize_session=False)
+        for event, tx_ids in dead_txs.items():
+            cls._set_send(event, tx_ids, SendEnum.NOT_PUSH.value, Transaction.SEND_DEAD, session)
+        if commit:
+            session.commit()
+        return dead
+
+    @classmethod
+    def postpone(cls, ids, seconds, error=None, *, commit=True, session=None):
+        """推迟推送, 不计入失败次数, 用于项目回调熔断期间"""
+        if not ids:
+            return 0
+        session = session or db.session()
+        values = {'next_attempt_at': datetime.now() + timedelta(seconds=seconds)}
+        if error:
+            values['last_error'] = error[:512]
+        updated = session.query(cls).filter(cls.id.in_(ids)).update(values, synchronize_session=False)
+        if commit:
+            session.commit()
+        return updated
+
+    @classmethod
+    def _set_send(cls, event, tx_ids, from_value, to_value, session):
+        """通知对应的交易推送字段由 from_value 改为 to_value, 确认状态已变化的不修改"""
+        send_field = cls.EVENT_SEND_FIELDS[event]
+        return session.query(Transaction).filter(
+            Transaction.id.in_(tx_ids), Transaction.confirm_status == event,
+            getattr(Transaction, send_field) == from_value).update({send_field: to_value}, synchronize_session=False)
+
+    @classmethod
+    def retry_dead(cls, tx_ids=None, *, commit=True, session=None):
+        """死信重新进入队列, 立即推送, 交易推送字段恢复为未推"""
+        session = session or db.session()
+        query = session.query(cls).filter(cls.status == cls.DEAD)
+        if tx_ids is not None:
+            query = query.filter(cls.tx_id.in_(tx_ids))
+        dead_txs = {}
+        for tx_id, event in query.with_entities(cls.tx_id, cls.event):
+            dead_txs.setdefault(event, []).append(tx_id)
+        for event, ids in dead_txs.items():
+            cls._set_send(event, ids, Transaction.SEND_DEAD, SendEnum.NOT_PUSH.value, session)
+        updated = query.update({'status': cls.PENDING, 'attempts': 0, 'next_attempt_at': datetime.now()},
+                               synchronize_session=False)
+        if commit:
+            session.commit()
+        return updated
+
+
 if __name__ == '__main__':
     pass
     # from flask import Flask
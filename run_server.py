@@ -13,6 +13,7 @@ from models.models import ApiAuth
 from exts import db
 from config.config import config
 from tasks.scan_chain import ScanEthereumChain
+from tasks.metrics import ScanMetrics, scan_metrics
 from lock import ProcessLock
 
 app = Flask(__name__)
@@ -60,6 +61,13 @@ def ping():
     return 'pong'
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # 扫链在持有调度锁的进程或后台任务进程中运行, 这里读取其写出的快照
+    snapshot = ScanMetrics.read_snapshot(scan_metrics.snapshot_file)
+    return make_response(ScanMetrics.to_prometheus(snapshot), 200, {'Content-Type': 'text/plain; version=0.0.4'})
+
+
 @app.route('/check', methods=['GET', 'POST'])
 def hello_world():
     api = ApiAuth.query.filter_by(access_key='123').first()
@@ -80,10 +88,12 @@ db.init_app(app)
 ScanEthereumChain.read_address()
 ScanEthereumChain.read_coins()
 
-scheduler = APScheduler()
-scheduler.init_app(app)
-scheduler_lock = ProcessLock(scheduler.start, filename='wallet-manage-scheduler.lock')
-scheduler_lock.lock_run()
+# 使用 run_worker.py 运行后台任务时关闭, web 进程只处理请求
+if getattr(config, 'WEB_SCHEDULER', True):
+    scheduler = APScheduler()
+    scheduler.init_app(app)
+    scheduler_lock = ProcessLock(scheduler.start, filename='wallet-manage-scheduler.lock')
+    scheduler_lock.lock_run()
 
 if __name__ == '__main__':
     app.run(port=config.PORT)
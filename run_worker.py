@@ -0,0 +1,178 @@
+"""
+后台任务进程
+
+扫链、上账、归集、打手续费在独立进程中运行, 使用自己的数据库连接池与并发限制,
+web 进程设置 WEB_SCHEDULER: false 后只处理 HTTP 请求.
+
+    python3 run_worker.py
+
+任务由 WORKER_JOBS 配置, 每个任务在 asyncio 中循环调度, 实际执行放在线程池中:
+    WORKER_JOBS:
+      - func: 'tasks.scan_chain:run_sync'
+        interval: 10         # 两次执行之间的间隔, 秒
+        concurrency: 1       # 同一任务同时执行的数量
+      - func: 'tasks.scan_chain:run_follow'
+        long_running: true   # 常驻任务, 只启动一次, 以 stop_event 通知退出
+      - func: 'tasks.scan_chain:run_notifier'
+        long_running: true   # 常驻上账, 与扫链在同一进程时扫链提交后立即唤醒
+
+归集与打手续费需要项目的钱包密码, 密码只通过接口设置在进程内存中, 未设置密码的项目跳过归集与打手续费.
+"""
+import asyncio
+import importlib
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+
+from config import runtime
+from config.config import config
+from exts import db
+from lock import ProcessLock
+from log import logger_attr
+from tasks.scan_chain import ScanEthereumChain
+
+DEFAULT_JOBS = [
+    {"func": 'tasks.scan_chain:run_sync', "interval": 10},
+    {"func": 'tasks.scan_chain:run_notifier', "long_running": True},
+    {"func": 'tasks.scan_chain:collection_eth', "interval": 60},
+    {"func": 'tasks.scan_chain:render_eth', "interval": 60},
+]
+
+
+def import_func(path):
+    module, name = path.split(':')
+    return getattr(importlib.import_module(module), name)
+
+
+@logger_attr
+class Worker(object):
+    """
+    :param jobs: list<dict>, 同 WORKER_JOBS
+    :param max_workers: 线程池大小, 即全部任务同时执行的上限
+    """
+    # 常驻任务异常退出后的重启间隔, 秒
+    RESTART_MIN = 5
+    RESTART_MAX = 300
+
+    def __init__(self, jobs, max_workers=4):
+        self.jobs = jobs
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='worker')
+        # 通知常驻任务退出
+        self.stop_event = threading.Event()
+        self._stopping = None
+
+    async def run_job(self, job):
+        try:
+            await self._run_job(job)
+        except Exception as e:
+            # 任务配置错误等无法继续运行时, 通知其它任务退出, 避免进程挂起
+            self.logger.exception('任务 {} 无法运行, 进程退出: {}'.format(job.get('func'), e))
+            self.stop()
+
+    async def run_long_running(self, name, func):
+        """常驻任务异常或意外返回时按退避间隔重启, 运行超过 RESTART_MAX 秒后重置间隔"""
+        loop = asyncio.get_event_loop()
+        delay = self.RESTART_MIN
+        while not self._stopping.is_set():
+            started = time.time()
+            try:
+                await loop.run_in_executor(self.executor, lambda: func(stop_event=self.stop_event))
+                if self._stopping.is_set():
+                    break
+                self.logger.warning('常驻任务 {} 意外退出'.format(name))
+            except Exception as e:
+                self.logger.exception('常驻任务 {} 出现异常: {}'.format(name, e))
+            if time.time() - started > self.RESTART_MAX:
+                delay = self.RESTART_MIN
+            self.logger.info('常驻任务 {} {} 秒后重启'.format(name, delay))
+            try:
+                await asyncio.wait_for(self._stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, self.RESTART_MAX)
+
+    async def _run_job(self, job):
+        func = import_func(job['func'])
+        loop = asyncio.get_event_loop()
+        if job.get('long_running'):
+            await self.run_long_running(job['func'], func)
+            return
+
+        interval = job.get('interval', 60)
+        limit = asyncio.Semaphore(job.get('concurrency', 1))
+        running = set()
+        while not self._stopping.is_set():
+            await limit.acquire()
+            if self._stopping.is_set():
+                limit.release()
+                break
+            future = loop.run_in_executor(self.executor, self.call, job['func'], func)
+            future.add_done_callback(lambda _: limit.release())
+            running.add(future)
+            future.add_done_callback(running.discard)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+        if running:
+            # 等待正在执行的任务完成
+            await asyncio.wait(running)
+
+    def call(self, name, func):
+        try:
+            func()
+        except Exception as e:
+            self.logger.exception('任务 {} 出现异常: {}'.format(name, e))
+
+    async def main(self):
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        self.logger.info('后台任务进程启动, 任务: {}'.format([job['func'] for job in self.jobs]))
+        try:
+            await asyncio.gather(*(self.run_job(job) for job in self.jobs))
+        finally:
+            self.stop_event.set()
+            self.executor.shutdown(wait=True)
+        self.logger.info('后台任务进程退出')
+
+    def stop(self):
+        self.logger.info('收到退出信号, 等待正在执行的任务完成')
+        self._stopping.set()
+        self.stop_event.set()
+
+    def run(self):
+        asyncio.get_event_loop().run_until_complete(self.main())
+
+
+def create_app():
+    app = Flask(__name__)
+    app.config.from_object(config)
+    # 后台进程使用独立的连接池
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+        getattr(config, 'SQLALCHEMY_ENGINE_OPTIONS', None) or {},
+        pool_size=getattr(config, 'WORKER_DB_POOL_SIZE', 10),
+        pool_recycle=getattr(config, 'WORKER_DB_POOL_RECYCLE', 3600))
+    db.init_app(app)
+    return app
+
+
+def main():
+    app = create_app()
+    runtime.app = app
+    ScanEthereumChain.read_address()
+    ScanEthereumChain.read_coins()
+
+    worker = Worker(getattr(config, 'WORKER_JOBS', None) or DEFAULT_JOBS,
+                    max_workers=getattr(config, 'WORKER_MAX_THREADS', 4))
+    # 同一主机只运行一个后台任务进程
+    ProcessLock(worker.run, filename='wallet-manage-worker.lock').lock_run()
+
+
+if __name__ == '__main__':
+    main()
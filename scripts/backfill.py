@@ -0,0 +1,40 @@
+"""
+历史补扫
+
+新增币种或导入旧地址后, 补扫指定高度区间内这些地址或合约的充值, 不影响正在运行的扫链.
+
+示例:
+    python3 -m scripts.backfill --start 10000000 --end 10100000 --contract 0xbed2d19d9551f6666c31ce2a72eb4533262d5dab
+    python3 -m scripts.backfill --start 10000000 --end 10100000 --address 0xaeb1... --address 0x69eb...
+"""
+import argparse
+
+from flask import Flask
+
+from config import runtime
+from config.config import config
+from exts import db
+from tasks.scan_chain import ScanEthereumChain, run_backfill
+
+
+def main():
+    parser = argparse.ArgumentParser(description='历史补扫')
+    parser.add_argument('--start', type=int, required=True, help='起始高度, 包含')
+    parser.add_argument('--end', type=int, required=True, help='结束高度, 不包含')
+    parser.add_argument('--address', action='append', help='只补扫该地址, 可多次指定')
+    parser.add_argument('--contract', action='append',
+                        help='只补扫该代币合约, 可多次指定, 指定 {} 时包含主链币'.format(ScanEthereumChain.COIN_NAME))
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    db.init_app(app)
+    runtime.app = app
+
+    ScanEthereumChain.read_coins()
+    synced = run_backfill(args.start, args.end, args.address, args.contract)
+    print('已补扫至: {}'.format(synced))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+-- 已部署数据库升级, db.create_all() 不会修改已存在的表, 需在更新代码前执行一次:
+--     mysql -h <host> -u <user> -p <database> < scripts/upgrade.sql
+-- tx 表较大时 ALTER 耗时较长, 列与索引合并为一条语句只重建一次表.
+
+-- 交易表: 未确认充值跟踪及按 id 分页查询待推送交易
+ALTER TABLE tx
+    ADD COLUMN block_hash VARCHAR(128) COMMENT '交易所在块hash',
+    ADD COLUMN confirm_status SMALLINT NOT NULL DEFAULT '1' COMMENT '确认状态 0:未确认 1:已确认 2:已被重组丢弃',
+    ADD COLUMN seen_send SMALLINT NOT NULL DEFAULT '2' COMMENT '未确认(及丢弃)通知是否推送 0:未推 1:已推 2:不用推',
+    ADD INDEX ix_tx_confirm_status (confirm_status),
+    ADD INDEX ix_is_send_id (is_send, id),
+    ADD INDEX ix_seen_send_id (seen_send, id);
+
+-- 分片扫链租约
+CREATE TABLE IF NOT EXISTS scan_lease (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    coin_id INTEGER NOT NULL COMMENT '主链币 ID',
+    start_height INTEGER NOT NULL COMMENT '起始高度, 包含',
+    end_height INTEGER NOT NULL COMMENT '结束高度, 不包含',
+    scanned_height INTEGER NOT NULL COMMENT '区间内已同步高度',
+    worker VARCHAR(128) NOT NULL COMMENT '租用者',
+    `status` SMALLINT NOT NULL COMMENT '0:租用中 1:已完成',
+    lease_expire DATETIME NOT NULL COMMENT '租约到期时间',
+    create_time DATETIME NOT NULL COMMENT '创建时间',
+    update_time DATETIME NOT NULL COMMENT '更新时间',
+    PRIMARY KEY (id),
+    CONSTRAINT uk_coin_id_start_height UNIQUE (coin_id, start_height),
+    INDEX ix_scan_lease_lease_expire (lease_expire)
+) ENGINE=INNODB;
+
+-- 项目回调队列, 已有未推送的充值由上账补漏自动加入
+CREATE TABLE IF NOT EXISTS notify_queue (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    tx_id BIGINT NOT NULL COMMENT '交易表关联键',
+    event SMALLINT NOT NULL COMMENT '通知类型 0:未确认 1:已确认 2:已被重组丢弃',
+    `status` SMALLINT NOT NULL COMMENT '0:待推送 1:已完成 2:死信',
+    attempts INTEGER NOT NULL COMMENT '已推送次数',
+    next_attempt_at DATETIME NOT NULL COMMENT '下次推送时间',
+    last_error VARCHAR(512) COMMENT '最近一次推送错误',
+    create_time DATETIME NOT NULL COMMENT '创建时间',
+    update_time DATETIME NOT NULL COMMENT '更新时间',
+    PRIMARY KEY (id),
+    CONSTRAINT uk_tx_id_event UNIQUE (tx_id, event),
+    INDEX ix_status_next_attempt_at (`status`, next_attempt_at),
+    INDEX ix_status_id (`status`, id)
+) ENGINE=INNODB;
@@ -0,0 +1,62 @@
+"""
+自适应批量大小
+
+根据每批块的请求耗时、响应字节数与交易数量估算下一批的块数,
+使每批耗时接近目标时间, 同时不超过字节与交易数量上限.
+"""
+
+
+class AdaptiveBatchSize(object):
+    """
+    :param initial: 初始块数
+    :param min_size: 最小块数
+    :param max_size: 最大块数
+    :param target_seconds: 每批目标耗时
+    :param max_bytes: 每批响应字节上限
+    :param max_txs: 每批交易数量上限
+    :param smoothing: 增长时的平滑系数, 越大越依赖最近一次的测量
+    """
+
+    def __init__(self, initial, min_size, max_size, target_seconds=2.0, max_bytes=32 * 1024 * 1024,
+                 max_txs=20000, smoothing=0.5):
+        self.min_size = max(int(min_size), 1)
+        self.max_size = max(int(max_size), self.min_size)
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.max_txs = max_txs
+        self.smoothing = smoothing
+        self._size = float(self._clamp(initial))
+
+    def _clamp(self, size):
+        return min(max(size, self.min_size), self.max_size)
+
+    @property
+    def size(self):
+        return int(self._size)
+
+    def record(self, blocks, seconds, nbytes, tx_count):
+        """记录一批的测量结果, 更新下一批大小"""
+        if blocks <= 0:
+            return
+        limits = []
+        if seconds > 0:
+            limits.append(self.target_seconds * blocks / seconds)
+        if nbytes > 0 and self.max_bytes:
+            limits.append(self.max_bytes * blocks / nbytes)
+        if tx_count > 0 and self.max_txs:
+            limits.append(self.max_txs * blocks / tx_count)
+        if not limits:
+            desired = self.max_size
+        else:
+            desired = min(limits)
+        if desired < self._size:
+            # 超出目标时立即收缩
+            self._size = self._clamp(desired)
+            return
+        # 增长时平滑且单次最多翻倍, 避免一批空块后突然拉取过多
+        desired = min(desired, self._size * 2)
+        self._size = self._clamp(self._size + self.smoothing * (desired - self._size))
+
+    def backoff(self):
+        """请求出错或返回空块时减半"""
+        self._size = float(self._clamp(self._size / 2))
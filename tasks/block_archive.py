@@ -0,0 +1,213 @@
+"""
+本地原始块归档
+
+已过确认深度的完整块(含交易)追加写入分段文件, 重新扫描时优先从归档读取,
+减少对共享节点的请求. 每条记录为 eth_getBlockByNumber 批量响应中该块元素的原始字节, zlib 压缩,
+拉取时直接压缩原始字节, 不需要保留解码后的块.
+
+目录结构, 每个分段保存 SEGMENT_BLOCKS 个高度:
+    blocks-<起始高度>.seg   追加写入的 zlib 压缩记录
+    blocks-<起始高度>.idx   定长索引, 第 n 项为 起始高度 + n 的 (offset, length), length 为 0 表示不存在
+
+读取使用 mmap, 重组回滚时只清空索引项, 分段数据保持只追加.
+未达到确认数的块先暂存在进程内共享的归档对象中, 扫链对象每次同步重新创建, 暂存的块不随之丢失.
+"""
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from config.config import config
+from log import logger_attr
+
+SEGMENT_BLOCKS = 10000
+INDEX_ENTRY = struct.Struct('<QI')
+# 同时打开的分段数量上限
+MAX_OPEN_SEGMENTS = 16
+
+
+class _Segment(object):
+    """单个分段, 进程内读写经过 BlockArchive 的锁, 进程间写入使用分段文件的 flock"""
+
+    def __init__(self, path, start):
+        self.start = start
+        self.seg_path = os.path.join(path, 'blocks-{:010d}.seg'.format(start))
+        self.idx_path = os.path.join(path, 'blocks-{:010d}.idx'.format(start))
+        self._seg_map = None
+        self._seg_fd = None
+        self._idx_fd = None
+
+    def _open(self):
+        if self._seg_fd is None:
+            self._seg_fd = os.open(self.seg_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+            self._idx_fd = os.open(self.idx_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def entry(self, height):
+        self._open()
+        data = os.pread(self._idx_fd, INDEX_ENTRY.size, (height - self.start) * INDEX_ENTRY.size)
+        if len(data) < INDEX_ENTRY.size:
+            return 0, 0
+        return INDEX_ENTRY.unpack(data)
+
+    def read(self, height):
+        offset, length = self.entry(height)
+        if not length:
+            return None
+        if self._seg_map is None or offset + length > len(self._seg_map):
+            # 文件已追加, 重新映射
+            if self._seg_map is not None:
+                self._seg_map.close()
+            self._seg_map = mmap.mmap(self._seg_fd, 0, access=mmap.ACCESS_READ)
+        return zlib.decompress(self._seg_map[offset:offset + length])
+
+    def write(self, height, data):
+        self._open()
+        # 多个进程可能写同一分段, 文件锁内追加数据并更新索引
+        fcntl.flock(self._seg_fd, fcntl.LOCK_EX)
+        try:
+            os.write(self._seg_fd, data)
+            # O_APPEND 写入后的位置即本条记录的末尾
+            offset = os.lseek(self._seg_fd, 0, os.SEEK_CUR) - len(data)
+            # 先写数据后写索引, 中途退出只会留下无索引的数据
+            os.pwrite(self._idx_fd, INDEX_ENTRY.pack(offset, len(data)), (height - self.start) * INDEX_ENTRY.size)
+        finally:
+            fcntl.flock(self._seg_fd, fcntl.LOCK_UN)
+
+    def clear(self, height, end_height=None):
+        """清空 [height, end_height) 的索引项"""
+        self._open()
+        fcntl.flock(self._seg_fd, fcntl.LOCK_EX)
+        try:
+            size = os.fstat(self._idx_fd).st_size
+            pos = max(height - self.start, 0) * INDEX_ENTRY.size
+            end = size if end_height is None else min(max(end_height - self.start, 0) * INDEX_ENTRY.size, size)
+            if pos < end:
+                os.pwrite(self._idx_fd, bytes(end - pos), pos)
+        finally:
+            fcntl.flock(self._seg_fd, fcntl.LOCK_UN)
+
+    def close(self):
+        if self._seg_map is not None:
+            self._seg_map.close()
+            self._seg_map = None
+        for fd in (self._seg_fd, self._idx_fd):
+            if fd is not None:
+                os.close(fd)
+        self._seg_fd = self._idx_fd = None
+
+
+@logger_attr
+class BlockArchive(object):
+    """
+    原始块归档
+    :param path: 归档目录
+    :param level: zlib 压缩级别
+    """
+
+    def __init__(self, path, level=6):
+        self.path = path
+        self.level = level
+        self._segments = {}
+        # 已入库但未达到确认数的块, {height: pack 的结果}
+        self._pending = {}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _segment(self, height):
+        start = height - height % SEGMENT_BLOCKS
+        segment = self._segments.pop(start, None)
+        if segment is None:
+            segment = _Segment(self.path, start)
+            if len(self._segments) >= MAX_OPEN_SEGMENTS:
+                # 关闭最久未使用的分段
+                oldest = next(iter(self._segments))
+                self._segments.pop(oldest).close()
+        # 重新插入保持最近使用的在末尾
+        self._segments[start] = segment
+        return segment
+
+    def pack(self, data):
+        """压缩一个块的原始响应元素, 结果用于 put"""
+        return zlib.compress(data, self.level)
+
+    def contains(self, start, end):
+        """[start, end) 的块是否都已归档"""
+        with self._lock:
+            return all(self._segment(height).entry(height)[1] for height in range(start, end))
+
+    def get(self, height):
+        """获取完整块, 不存在返回 None"""
+        with self._lock:
+            data = self._segment(height).read(height)
+        if data is None:
+            return None
+        return json.loads(data)['result']
+
+    def put(self, records):
+        """
+        追加块, 已存在的高度以新数据覆盖索引
+        :param records: iterable<tuple<height, pack 的结果>>
+        """
+        for height, data in records:
+            with self._lock:
+                self._segment(height).write(height, data)
+
+    def stage(self, records):
+        """
+        暂存未达到确认数的块, 由 flush 写入
+        :param records: iterable<tuple<height, pack 的结果>>
+        """
+        with self._lock:
+            self._pending.update(records)
+
+    def flush(self, confirmed_height):
+        """
+        写入高度不超过 confirmed_height 的暂存块
+        :return: 写入的块数
+        """
+        with self._lock:
+            heights = sorted(height for height in self._pending if height <= confirmed_height)
+            records = [(height, self._pending.pop(height)) for height in heights]
+        self.put(records)
+        return len(records)
+
+    def invalidate(self, height, end_height=None):
+        """重组回滚, 使高度 >= height (且 < end_height) 的块失效, 同时丢弃这些高度的暂存块"""
+        with self._lock:
+            for h in list(self._pending):
+                if h >= height and (end_height is None or h < end_height):
+                    del self._pending[h]
+            starts = set(self._segments)
+            for name in os.listdir(self.path):
+                if name.startswith('blocks-') and name.endswith('.idx'):
+                    starts.add(int(name[len('blocks-'):-len('.idx')]))
+            for start in sorted(starts):
+                if start + SEGMENT_BLOCKS <= height or (end_height is not None and start >= end_height):
+                    continue
+                self._segment(start).clear(height, end_height)
+        self.logger.info('归档高度 {} -- {} 的块已失效'.format(height, end_height or ''))
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments = {}
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+
+def get_archive():
+    """进程内共享的归档, 未配置 BLOCK_ARCHIVE_DIR 时返回 None"""
+    global _archive
+    path = getattr(config, 'BLOCK_ARCHIVE_DIR', None)
+    if not path:
+        return None
+    with _archive_lock:
+        if _archive is None:
+            _archive = BlockArchive(path, getattr(config, 'BLOCK_ARCHIVE_LEVEL', 6))
+    return _archive
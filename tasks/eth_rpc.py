@@ -0,0 +1,188 @@
+"""
+以太坊 JSON-RPC 批量请求
+
+驱动中的 RPC 每个方法都是一次 HTTP 请求, 扫链中需要大量同类请求时,
+使用此处的批量请求将多个调用合并到一次 HTTP 往返中.
+"""
+import json
+
+import requests
+
+from digit import digit
+from exceptions import SyncError
+from log import logger_attr
+from tasks.json_stream import iter_array_items
+
+# 节点不支持该方法时返回的错误码
+METHOD_NOT_FOUND = -32601
+# ERC20 Transfer(address indexed from, address indexed to, uint256 value)
+TRANSFER_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+# ERC20 transfer(address,uint256) 与 transferFrom(address,address,uint256) 的方法选择器
+TRANSFER_SELECTOR = '0xa9059cbb'
+TRANSFER_FROM_SELECTOR = '0x23b872dd'
+
+
+@logger_attr
+class EthBatchRpc(object):
+    """JSON-RPC 批量请求, 单个失败的调用结果为 None"""
+    TIMEOUT = 30
+    # 流式读取响应时每次读取的字节数
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, host, timeout=None):
+        self.host = host
+        self.timeout = timeout or self.TIMEOUT
+        self.session = requests.Session()
+        # None 为未探测, 首次调用 eth_getBlockReceipts 后确定
+        self.block_receipts_supported = None
+
+    def batch(self, calls):
+        """
+        :param calls: list<tuple<method, params>>
+        :return: list<tuple<result, error>>, 与 calls 顺序一致
+        """
+        if not calls:
+            return []
+        return self._batch(calls)[0]
+
+    def _batch(self, calls):
+        """同 batch, 额外返回响应字节数"""
+        payload = [{"jsonrpc": "2.0", "id": idx, "method": method, "params": params}
+                   for idx, (method, params) in enumerate(calls)]
+        rsp = self.session.post(self.host, json=payload, timeout=self.timeout)
+        rsp.raise_for_status()
+        nbytes = len(rsp.content)
+        body = rsp.json()
+        return self._order(calls, body), nbytes
+
+    def _order(self, calls, body):
+        """按请求顺序排列批量响应"""
+        if isinstance(body, dict):
+            # 整个批量请求被拒绝
+            self.logger.error('批量请求被节点拒绝: {}'.format(body.get('error')))
+            return [(None, body.get('error'))] * len(calls)
+
+        results = [(None, None)] * len(calls)
+        for item in body:
+            idx = item.get('id')
+            if isinstance(idx, int) and 0 <= idx < len(calls):
+                results[idx] = (item.get('result'), item.get('error'))
+        return results
+
+    def get_blocks(self, heights, full_tx=True, prune=None, handler=None):
+        """
+        批量获取块, 响应边接收边按块解码, 交易在解码过程中即被裁剪, 同一时间只有一个块在内存中
+        :param heights: iterable<int>
+        :param prune: callable(transaction), 每笔交易解码后立即调用, 返回裁剪后的交易
+        :param handler: callable(block, data), 每个块解码后立即调用, data 为该块响应元素的原始字节,
+                        返回值代替块保存在结果中, 用于只保留需要的数据
+        :return: (list<block or handler 返回值 or None>, 响应字节数)
+        """
+        calls = [('eth_getBlockByNumber', [digit.int_to_hex(height), full_tx]) for height in heights]
+        if not calls:
+            return [], 0
+        payload = [{"jsonrpc": "2.0", "id": idx, "method": method, "params": params}
+                   for idx, (method, params) in enumerate(calls)]
+        counter = [0]
+
+        def chunks(rsp):
+            for chunk in rsp.iter_content(self.STREAM_CHUNK_SIZE):
+                counter[0] += len(chunk)
+                yield chunk
+
+        object_hook = None
+        if prune is not None:
+            # 只有交易含 transactionIndex
+            object_hook = lambda obj: prune(obj) if 'transactionIndex' in obj else obj
+
+        blocks = [None] * len(calls)
+        with self.session.post(self.host, json=payload, timeout=self.timeout, stream=True) as rsp:
+            rsp.raise_for_status()
+            for data in iter_array_items(chunks(rsp)):
+                item = json.loads(data, object_hook=object_hook)
+                if 'id' not in item and 'error' in item:
+                    # 整个批量请求被拒绝
+                    self.logger.error('批量请求被节点拒绝: {}'.format(item.get('error')))
+                    break
+                idx, block = item.get('id'), item.get('result')
+                if not isinstance(idx, int) or not 0 <= idx < len(calls) or block is None:
+                    continue
+                blocks[idx] = block if handler is None else handler(block, data)
+        return blocks, counter[0]
+
+    def get_transaction_receipts(self, tx_hashes, block_heights=None):
+        """
+        批量获取交易 receipt, 正常情况下一次 HTTP 往返
+        :param tx_hashes: dict<tx_hash, hex height>, 需要获取 receipt 的交易及其所在高度
+        :param block_heights: set<hex height>, 这些块使用 eth_getBlockReceipts 整块获取,
+                              节点不支持时自动退回按交易获取
+        :return: dict<tx_hash(小写), receipt>
+        """
+        wanted = {tx_hash.lower(): height for tx_hash, height in tx_hashes.items()}
+        if self.block_receipts_supported is False:
+            block_heights = []
+        block_heights = list(block_heights or [])
+        by_hash = [tx_hash for tx_hash, height in wanted.items() if height not in block_heights]
+
+        calls = [('eth_getBlockReceipts', [height]) for height in block_heights]
+        calls += [('eth_getTransactionReceipt', [tx_hash]) for tx_hash in by_hash]
+        results = self.batch(calls)
+
+        receipts = {}
+        for result, error in results[:len(block_heights)]:
+            if error and error.get('code') == METHOD_NOT_FOUND:
+                self.logger.info('节点不支持 eth_getBlockReceipts, 退回按交易获取 receipt')
+                self.block_receipts_supported = False
+                continue
+            if result is None:
+                continue
+            self.block_receipts_supported = True
+            for receipt in result:
+                tx_hash = (receipt.get('transactionHash') or '').lower()
+                if tx_hash in wanted:
+                    receipts[tx_hash] = receipt
+        for tx_hash, (result, error) in zip(by_hash, results[len(block_heights):]):
+            if result is not None:
+                receipts[tx_hash] = result
+
+        # 整块获取失败的部分再按交易补一次
+        missing = [tx_hash for tx_hash in wanted if tx_hash not in receipts]
+        if missing and block_heights:
+            calls = [('eth_getTransactionReceipt', [tx_hash]) for tx_hash in missing]
+            for tx_hash, (result, error) in zip(missing, self.batch(calls)):
+                if result is not None:
+                    receipts[tx_hash] = result
+        return receipts
+
+    def get_transactions(self, tx_hashes):
+        """
+        批量获取交易
+        :param tx_hashes: list<str>
+        :return: dict<tx_hash(小写), transaction>
+        """
+        tx_hashes = list(tx_hashes)
+        calls = [('eth_getTransactionByHash', [tx_hash]) for tx_hash in tx_hashes]
+        return {tx_hash.lower(): result for tx_hash, (result, error) in zip(tx_hashes, self.batch(calls))
+                if result is not None}
+
+    def get_logs(self, from_height, to_height, contracts, topics):
+        """
+        获取 [from_height, to_height] 范围内的日志,
+        节点因结果过多拒绝时对半拆分区间重试
+        :param from_height: int
+        :param to_height: int, 包含
+        :param contracts: list<str>, 合约地址
+        :param topics: list, 同 eth_getLogs topics
+        :return: list<log>
+        """
+        log_filter = {"fromBlock": digit.int_to_hex(from_height), "toBlock": digit.int_to_hex(to_height),
+                      "address": list(contracts), "topics": topics}
+        result, error = self.batch([('eth_getLogs', [log_filter])])[0]
+        if error is None and result is not None:
+            return result
+        if from_height >= to_height:
+            raise SyncError('获取高度 {} 日志失败: {}'.format(from_height, error))
+        self.logger.info('获取日志 {} -- {} 失败, 拆分区间重试: {}'.format(from_height, to_height, error))
+        middle = (from_height + to_height) // 2
+        return (self.get_logs(from_height, middle, contracts, topics) +
+                self.get_logs(middle + 1, to_height, contracts, topics))
@@ -0,0 +1,215 @@
+"""
+新块通知
+
+通过 WebSocket eth_subscribe("newHeads") 订阅新块, 有新块时立即唤醒扫链.
+连接断开时按退避间隔重连, 期间扫链退化为按 SCAN_POLL_SECONDS 轮询.
+节点只需 WebSocket 基础帧协议, 这里直接基于 socket 实现, 不引入额外依赖.
+"""
+import base64
+import hashlib
+import json
+import os
+import socket
+import ssl
+import struct
+import threading
+import time
+from urllib.parse import urlparse
+
+from digit import digit
+from log import logger_attr
+
+_WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+class WebSocketError(Exception):
+    pass
+
+
+class WebSocket(object):
+    """最小 WebSocket 客户端, 只支持收发文本消息"""
+
+    def __init__(self, url, timeout=30):
+        self.url = url
+        self.timeout = timeout
+        self.sock = None
+        self._buf = b''
+
+    def connect(self):
+        parsed = urlparse(self.url)
+        secure = parsed.scheme == 'wss'
+        port = parsed.port or (443 if secure else 80)
+        sock = socket.create_connection((parsed.hostname, port), timeout=self.timeout)
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=parsed.hostname)
+        key = base64.b64encode(os.urandom(16)).decode()
+        path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+        request = ('GET {} HTTP/1.1\r\nHost: {}:{}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                   'Sec-WebSocket-Key: {}\r\nSec-WebSocket-Version: 13\r\n\r\n').format(
+            path, parsed.hostname, port, key)
+        sock.sendall(request.encode())
+        self.sock = sock
+
+        header = b''
+        while b'\r\n\r\n' not in header:
+            data = sock.recv(4096)
+            if not data:
+                raise WebSocketError('握手时连接关闭')
+            header += data
+        header, self._buf = header.split(b'\r\n\r\n', 1)
+        lines = header.decode('latin-1').split('\r\n')
+        if ' 101 ' not in lines[0] + ' ':
+            raise WebSocketError('握手失败: {}'.format(lines[0]))
+        headers = {k.strip().lower(): v.strip() for k, v in (line.split(':', 1) for line in lines[1:] if ':' in line)}
+        accept = base64.b64encode(hashlib.sha1((key + _WS_GUID).encode()).digest()).decode()
+        if headers.get('sec-websocket-accept') != accept:
+            raise WebSocketError('握手校验失败')
+
+    def _recv_exact(self, size):
+        while len(self._buf) < size:
+            data = self.sock.recv(max(size - len(self._buf), 4096))
+            if not data:
+                raise WebSocketError('连接已关闭')
+            self._buf += data
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def _send_frame(self, opcode, payload):
+        # 客户端发送的帧必须掩码
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < 1 << 16:
+            header += bytes([0x80 | 126]) + struct.pack('!H', length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack('!Q', length)
+        mask = os.urandom(4)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self.sock.sendall(header + mask + masked)
+
+    def send(self, text):
+        self._send_frame(OP_TEXT, text.encode())
+
+    def recv(self):
+        """接收一条完整消息, 自动回复 ping"""
+        message, message_op = b'', None
+        while True:
+            first, second = self._recv_exact(2)
+            fin, opcode = first & 0x80, first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', self._recv_exact(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self._recv_exact(8))[0]
+            mask = self._recv_exact(4) if second & 0x80 else None
+            payload = self._recv_exact(length)
+            if mask:
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+            if opcode == OP_PING:
+                self._send_frame(OP_PONG, payload)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_CLOSE:
+                raise WebSocketError('节点关闭连接')
+            if opcode != OP_CONTINUATION:
+                message_op = opcode
+            message += payload
+            if fin:
+                return message.decode() if message_op == OP_TEXT else message
+
+    def close(self):
+        if self.sock is None:
+            return
+        try:
+            self._send_frame(OP_CLOSE, b'')
+        except OSError:
+            pass
+        self.sock.close()
+        self.sock = None
+
+
+@logger_attr
+class HeadWatcher(object):
+    """
+    新块订阅, 在后台线程中维持连接
+    :param ws_url: 节点 WebSocket 地址
+    :param coalesce_seconds: 被唤醒后再等待的时间, 合并短时间内连续到达的新块
+    :param idle_seconds: 超过该时间未收到新块视为连接失效, 重新订阅
+    """
+    RECONNECT_MIN = 1
+    RECONNECT_MAX = 60
+
+    def __init__(self, ws_url, coalesce_seconds=0.2, idle_seconds=120):
+        self.ws_url = ws_url
+        self.coalesce_seconds = coalesce_seconds
+        self.idle_seconds = idle_seconds
+        # 最近收到的新块高度
+        self.height = None
+        self.connected = False
+        self._event = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='head-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._event.set()
+
+    def wait(self, timeout):
+        """
+        等待新块, 超时返回 False, 调用方按轮询处理
+        扫链期间到达的新块会使下一次 wait 立即返回, 多个新块只唤醒一次
+        """
+        if not self._event.wait(timeout):
+            return False
+        if self.coalesce_seconds:
+            self._stop.wait(self.coalesce_seconds)
+        self._event.clear()
+        return True
+
+    def _run(self):
+        delay = self.RECONNECT_MIN
+        while not self._stop.is_set():
+            ws = WebSocket(self.ws_url, timeout=self.idle_seconds)
+            try:
+                ws.connect()
+                ws.send(json.dumps({"jsonrpc": "2.0", "id": 1, "method": "eth_subscribe", "params": ["newHeads"]}))
+                subscription = None
+                while not self._stop.is_set():
+                    message = json.loads(ws.recv())
+                    if message.get('id') == 1:
+                        if message.get('error'):
+                            raise WebSocketError('订阅失败: {}'.format(message['error']))
+                        subscription = message.get('result')
+                        self.connected = True
+                        delay = self.RECONNECT_MIN
+                        self.logger.info('已订阅新块通知 {}'.format(self.ws_url))
+                        continue
+                    params = message.get('params') or {}
+                    if message.get('method') != 'eth_subscription' or params.get('subscription') != subscription:
+                        continue
+                    head = params.get('result') or {}
+                    if head.get('number'):
+                        self.height = digit.hex_to_int(head['number'])
+                    self._event.set()
+            except (OSError, ValueError, WebSocketError) as e:
+                if not self._stop.is_set():
+                    self.logger.warning('新块订阅断开, {} 秒后重连, 期间按间隔轮询: {}'.format(delay, e))
+            finally:
+                self.connected = False
+                ws.close()
+            self._stop.wait(delay)
+            delay = min(delay * 2, self.RECONNECT_MAX)
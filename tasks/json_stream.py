@@ -0,0 +1,88 @@
+"""
+流式 JSON 数组拆分
+
+JSON-RPC 批量响应是一个顶层数组, 这里边接收边拆分出每个元素的原始字节,
+调用方逐个 json.loads, 同一时间只有一个元素被解码为 Python 对象.
+只识别结构字符, 长字符串(如 input)由正则整段跳过.
+"""
+import re
+
+# 字符串外关注的结构字符
+_STRUCT = re.compile(rb'["{}\[\]]')
+# 字符串内关注的字符
+_STRING = re.compile(rb'["\\]')
+
+
+class JsonStreamError(ValueError):
+    pass
+
+
+def iter_array_items(chunks):
+    """
+    :param chunks: iterable<bytes>, 如 requests 的 iter_content
+    :return: generator<bytes>, 顶层数组中的每个元素; 顶层不是数组时整体作为一个元素产出
+    """
+    buf = bytearray()
+    pos = 0
+    depth = 0
+    in_string = False
+    item_start = None
+    top_object = False
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buf += chunk
+        while True:
+            if in_string:
+                match = _STRING.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    break
+                if match.group() == b'\\':
+                    if match.end() >= len(buf):
+                        # 转义字符在块末尾, 等待下一块
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                    continue
+                in_string = False
+                pos = match.end()
+                continue
+
+            match = _STRUCT.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            char = match.group()
+            pos = match.end()
+            if char == b'"':
+                in_string = True
+            elif char in (b'{', b'['):
+                if depth == 0 and char == b'{':
+                    # 顶层为对象, 如整个批量请求被拒绝
+                    top_object = True
+                    item_start = match.start()
+                elif depth == 1 and not top_object:
+                    item_start = match.start()
+                depth += 1
+            else:
+                depth -= 1
+                if depth < 0:
+                    raise JsonStreamError('JSON 结构错误')
+                if (depth == 1 and not top_object) or (depth == 0 and top_object):
+                    yield bytes(buf[item_start:pos])
+                    item_start = None
+                if depth == 0:
+                    return
+
+        # 丢弃已处理且不在当前元素内的数据
+        keep = item_start if item_start is not None else pos
+        if keep:
+            del buf[:keep]
+            pos -= keep
+            if item_start is not None:
+                item_start = 0
+
+    if depth != 0:
+        raise JsonStreamError('JSON 数据不完整')
@@ -0,0 +1,133 @@
+"""
+扫链指标
+
+每批块记录各阶段耗时与数量, 以结构化日志输出, 并写入快照文件.
+扫链运行在持有调度锁的进程中, 其他 web worker 通过读取快照文件对外提供 /metrics.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from config.config import config
+from log import logger_attr
+
+DEFAULT_SNAPSHOT_FILE = os.path.join(tempfile.gettempdir(), 'wallet-manage-scan-metrics.json')
+
+# 每批指标, 名称: 说明
+BATCH_FIELDS = {
+    'rpc_fetch_seconds': '拉取块及日志耗时',
+    'bytes_received': '拉取块响应字节数',
+    'archive_blocks': '从本地归档读取的块数量',
+    'blocks': '块数量',
+    'txs_resolved': '解析交易数量',
+    'txs_candidate': '通过预过滤进入完整解析的交易数量',
+    'deposits_matched': '命中充值数量',
+    'resolve_seconds': '解析耗时, 含获取 receipt',
+    'receipt_fetch_seconds': '获取 receipt 耗时',
+    'db_write_seconds': '写库耗时',
+    'commit_seconds': '提交耗时',
+    'blocks_per_second': '入库速度',
+    'lag': '距节点最高高度',
+    'synced_height': '已同步高度',
+}
+# 累加的指标
+TOTAL_FIELDS = ('rpc_fetch_seconds', 'bytes_received', 'archive_blocks', 'blocks', 'txs_resolved', 'txs_candidate',
+                'deposits_matched', 'resolve_seconds', 'receipt_fetch_seconds', 'db_write_seconds', 'commit_seconds')
+
+
+class BatchMetrics(dict):
+    """单批指标"""
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self[name] = self.get(name, 0) + time.time() - start
+
+    def incr(self, name, value=1):
+        self[name] = self.get(name, 0) + value
+
+
+@logger_attr
+class ScanMetrics(object):
+    """进程内扫链指标汇总"""
+
+    def __init__(self, snapshot_file=None):
+        self.snapshot_file = snapshot_file
+        self.totals = {name: 0 for name in TOTAL_FIELDS}
+        self.last = {}
+        self.batches = 0
+        self._last_persist = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """一次扫链开始, 入库速度从此时起算"""
+        with self._lock:
+            self._last_persist = time.time()
+
+    def observe(self, metrics, height, end_height, highest_height):
+        """一批入库完成后调用"""
+        now = time.time()
+        with self._lock:
+            if self._last_persist is not None and now > self._last_persist:
+                metrics['blocks_per_second'] = metrics.get('blocks', 0) / (now - self._last_persist)
+            self._last_persist = now
+            metrics['synced_height'] = end_height
+            if highest_height is not None:
+                metrics['lag'] = max(highest_height - end_height, 0)
+            for name in TOTAL_FIELDS:
+                self.totals[name] += metrics.get(name, 0)
+            self.batches += 1
+            self.last = dict(metrics)
+            snapshot = self.snapshot()
+
+        self.logger.info('扫链指标 {}'.format(json.dumps(
+            dict(metrics, event='scan_batch', height=height, end_height=end_height), sort_keys=True)))
+        if self.snapshot_file:
+            try:
+                self.write_snapshot(snapshot)
+            except OSError as e:
+                self.logger.warning('写入指标快照失败: {}'.format(e))
+
+    def snapshot(self):
+        return {'updated_at': time.time(), 'batches': self.batches, 'totals': dict(self.totals),
+                'last': dict(self.last)}
+
+    def write_snapshot(self, snapshot):
+        """先写临时文件再替换, 读取方不会读到半个文件"""
+        dirname = os.path.dirname(self.snapshot_file) or '.'
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.scan-metrics-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, self.snapshot_file)
+
+    @staticmethod
+    def read_snapshot(snapshot_file):
+        try:
+            with open(snapshot_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def to_prometheus(snapshot):
+        """快照转换为 Prometheus 文本格式"""
+        if not snapshot:
+            return ''
+        lines = ['wallet_scan_updated_at {}'.format(snapshot['updated_at']),
+                 'wallet_scan_batches_total {}'.format(snapshot['batches'])]
+        for name, value in sorted(snapshot['totals'].items()):
+            lines.append('wallet_scan_{}_total {}'.format(name, value))
+        for name, value in sorted(snapshot['last'].items()):
+            if name in BATCH_FIELDS:
+                lines.append('# HELP wallet_scan_last_{} {}'.format(name, BATCH_FIELDS[name]))
+                lines.append('wallet_scan_last_{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+scan_metrics = ScanMetrics(getattr(config, 'METRICS_FILE', DEFAULT_SNAPSHOT_FILE))
@@ -0,0 +1,282 @@
+"""
+项目回调推送
+
+每个回调主机使用一个保持连接的连接池, 推送在线程池中并发执行, 每个请求都有超时,
+推送结果汇总后由调用方批量更新推送状态. 开启批量回调的项目一个请求携带多笔充值.
+
+每个项目是一个推送通道, 通道之间按权重轮流占用并发, 每个通道有自己的同时推送上限及熔断,
+某个项目的回调超时或持续报错时只影响该项目自己的通知.
+
+扫链在写入交易的同一事务中加入回调队列, 提交后通过 signal_outbox 唤醒同一进程内的常驻上账,
+其它进程的常驻上账按 NotifyQueue 最大 ID 轮询发现新通知.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config.config import config
+from log import logger_attr
+
+
+class Notification(object):
+    """一条待推送的充值通知"""
+
+    def __init__(self, item, tx, send_field, project_id, params):
+        # 队列项及交易
+        self.item = item
+        self.tx = tx
+        # 推送成功后置为已推的 Transaction 字段
+        self.send_field = send_field
+        self.project_id = project_id
+        self.params = params
+
+
+class CallbackResult(object):
+    """单个回调的结果"""
+
+    def __init__(self, key, ok, status_code=None, error=None, body=None, skipped=False):
+        self.key = key
+        self.ok = ok
+        self.status_code = status_code
+        self.error = error
+        self.body = body
+        # 通道熔断, 未发出请求
+        self.skipped = skipped
+
+
+class CircuitBreaker(object):
+    """
+    通道熔断
+    连续失败 failure_threshold 次后打开, 打开期间不再推送; reset_seconds 秒后半开,
+    放行 half_open_max 个探测请求, 探测成功则关闭, 失败则重新打开
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_seconds=60, half_open_max=1):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.half_open_max = half_open_max
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """是否可以发出一个请求"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_seconds:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probes = 0
+            if self._probes < self.half_open_max:
+                self._probes += 1
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def retry_after(self):
+        """距离下一次探测的秒数, 未打开时为 0"""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(self.reset_seconds - (time.time() - self.opened_at), 0)
+
+
+@logger_attr
+class CallbackDispatcher(object):
+    """
+    回调并发推送
+    :param max_workers: 同时推送的请求数量上限
+    :param timeout: 连接超时及读取超时, 秒
+    :param pool_maxsize: 每个主机保持的连接数量
+    :param lanes: dict<通道, dict>, 单独设置通道的 weight 权重及 inflight 同时推送上限
+    :param lane_inflight: 未单独设置的通道同时推送上限
+    :param breaker_failures: 通道连续失败多少次后熔断
+    :param breaker_reset: 熔断多少秒后放行探测请求
+    """
+    NOTIFY_CONCURRENCY = 32
+    NOTIFY_TIMEOUT = (3, 10)
+    NOTIFY_LANE_INFLIGHT = 4
+    NOTIFY_BREAKER_FAILURES = 5
+    NOTIFY_BREAKER_RESET = 60
+
+    def __init__(self, max_workers=None, timeout=None, pool_maxsize=None, lanes=None, lane_inflight=None,
+                 breaker_failures=None, breaker_reset=None):
+        self.max_workers = max_workers or self.NOTIFY_CONCURRENCY
+        self.timeout = tuple(timeout) if timeout else self.NOTIFY_TIMEOUT
+        self.pool_maxsize = pool_maxsize or self.max_workers
+        self.lanes = {str(name): value or {} for name, value in (lanes or {}).items()}
+        self.lane_inflight = lane_inflight or self.NOTIFY_LANE_INFLIGHT
+        self.breaker_failures = breaker_failures or self.NOTIFY_BREAKER_FAILURES
+        self.breaker_reset = breaker_reset or self.NOTIFY_BREAKER_RESET
+        self._breakers = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='notify')
+
+    def session(self, url):
+        """按主机复用连接"""
+        parsed = urlparse(url)
+        host = (parsed.scheme, parsed.netloc)
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+        return session
+
+    def post(self, key, url, **kwargs):
+        """同步推送一个回调, 返回 CallbackResult, 不抛出异常"""
+        try:
+            rsp = self.session(url).post(url, timeout=self.timeout, **kwargs)
+        except Exception as e:
+            return CallbackResult(key, False, error=str(e))
+        ok = rsp.status_code == 200
+        return CallbackResult(key, ok, rsp.status_code, None if ok else 'HTTP {}'.format(rsp.status_code),
+                              rsp.content)
+
+    def breaker(self, lane):
+        """通道的熔断, 在多次上账之间保持状态"""
+        with self._lock:
+            breaker = self._breakers.get(lane)
+            if breaker is None:
+                breaker = CircuitBreaker(self.breaker_failures, self.breaker_reset)
+                self._breakers[lane] = breaker
+        return breaker
+
+    def lane_weight(self, lane):
+        return max(int(self.lanes.get(str(lane), {}).get('weight') or 1), 1)
+
+    def lane_limit(self, lane):
+        return max(int(self.lanes.get(str(lane), {}).get('inflight') or self.lane_inflight), 1)
+
+    def dispatch(self, calls, lane=None):
+        """
+        并发推送
+        请求按通道排队, 有空闲并发时从已发送数 / 权重最小的通道取出请求提交, 每个通道最多同时推送
+        lane_limit 个, 总数不超过 max_workers. 只在有空闲并发时才提交到线程池,
+        因此慢通道排队的请求不会占住其它通道的位置.
+        通道熔断时剩余请求不再发出, 结果标记为 skipped
+        :param calls: iterable<tuple<key, url, dict>>, dict 为 requests.post 的参数
+        :param lane: 由 key 取得所属通道的函数, 默认按回调主机分通道
+        :return: list<CallbackResult>, 与 calls 顺序一致
+        """
+        queues = OrderedDict()
+        count = 0
+        for idx, (key, url, kwargs) in enumerate(calls):
+            name = lane(key) if lane else urlparse(url).netloc
+            queues.setdefault(name, deque()).append((idx, key, url, kwargs))
+            count = idx + 1
+        results = [None] * count
+        inflight = dict.fromkeys(queues, 0)
+        # 已发送数量, 除以权重后最小的通道优先
+        served = dict.fromkeys(queues, 0)
+        running = [0]
+        cond = threading.Condition()
+
+        def on_done(idx, name, future):
+            result = future.result()
+            self.breaker(name).record(result.ok)
+            with cond:
+                results[idx] = result
+                inflight[name] -= 1
+                running[0] -= 1
+                cond.notify()
+
+        with cond:
+            while queues or running[0]:
+                # 半开等待探测结果的通道本轮不再发送
+                blocked = set()
+                while running[0] < self.max_workers:
+                    eligible = [name for name in queues
+                                if name not in blocked and inflight[name] < self.lane_limit(name)]
+                    if not eligible:
+                        break
+                    name = min(eligible, key=lambda n: served[n] / self.lane_weight(n))
+                    queue, breaker = queues[name], self.breaker(name)
+                    if not breaker.allow():
+                        # 打开时剩余请求全部跳过
+                        if breaker.state == CircuitBreaker.OPEN:
+                            while queue:
+                                idx, key, _, _ = queue.popleft()
+                                results[idx] = CallbackResult(key, False, error='回调熔断中', skipped=True)
+                            del queues[name]
+                        else:
+                            blocked.add(name)
+                        continue
+                    idx, key, url, kwargs = queue.popleft()
+                    served[name] += 1
+                    inflight[name] += 1
+                    running[0] += 1
+                    if not queue:
+                        del queues[name]
+                    future = self._executor.submit(self.post, key, url, **kwargs)
+                    future.add_done_callback(lambda f, idx=idx, name=name: on_done(idx, name, f))
+                if queues or running[0]:
+                    cond.wait(1)
+        return results
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """进程内共享的回调推送, 连接池在多次上账之间复用"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = CallbackDispatcher(getattr(config, 'NOTIFY_CONCURRENCY', None),
+                                             getattr(config, 'NOTIFY_TIMEOUT', None),
+                                             lanes=getattr(config, 'NOTIFY_LANES', None),
+                                             lane_inflight=getattr(config, 'NOTIFY_LANE_INFLIGHT', None),
+                                             breaker_failures=getattr(config, 'NOTIFY_BREAKER_FAILURES', None),
+                                             breaker_reset=getattr(config, 'NOTIFY_BREAKER_RESET', None))
+    return _dispatcher
+
+
+_outbox_event = threading.Event()
+
+
+def signal_outbox():
+    """回调队列有新通知"""
+    _outbox_event.set()
+
+
+def wait_outbox(timeout):
+    """等待新通知, 超时返回 False"""
+    if not _outbox_event.wait(timeout):
+        return False
+    _outbox_event.clear()
+    return True
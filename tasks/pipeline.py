@@ -0,0 +1,114 @@
+"""
+分段流水线
+
+将 拉取 -> 解析 -> 入库 拆分为多个阶段, 阶段之间使用有界队列连接,
+每个阶段在独立线程(gevent 下为协程)中运行, 使网络 IO 与数据库 IO 可以重叠.
+最后一个阶段在调用方线程中执行, 所以入库顺序与输入顺序保持一致.
+"""
+import queue
+import threading
+
+# 队列结束标记
+_STOP = object()
+
+
+class _StageError(object):
+    """阶段异常, 沿队列向下游传递"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class Pipeline(object):
+    """
+    有界队列流水线
+    stages: list<callable>, 除最后一个阶段外, 每个阶段的返回值作为下一阶段的入参,
+            阶段返回 None 时视为上游已结束, 后续输入将不再处理.
+    """
+
+    def __init__(self, stages, maxsize=2):
+        if not stages:
+            raise ValueError('流水线至少需要一个阶段')
+        self.stages = stages
+        self.maxsize = max(int(maxsize), 1)
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def stop(self):
+        """通知所有阶段停止"""
+        self._stopped.set()
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def _put(self, q, item):
+        # 下游已停止时不阻塞在满队列上
+        while True:
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                if self.stopped:
+                    return False
+
+    def _get(self, q):
+        while True:
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                if self.stopped:
+                    return _STOP
+
+    def _feed(self, items, out_q):
+        try:
+            for item in items:
+                if self.stopped or not self._put(out_q, item):
+                    break
+        finally:
+            self._put(out_q, _STOP)
+
+    def _work(self, func, in_q, out_q):
+        while True:
+            item = self._get(in_q)
+            if item is _STOP or isinstance(item, _StageError):
+                self._put(out_q, item)
+                return
+            try:
+                result = func(item)
+            except Exception as e:
+                self._put(out_q, _StageError(e))
+                return
+            if result is None:
+                self._put(out_q, _STOP)
+                return
+            if not self._put(out_q, result):
+                return
+
+    def run(self, items):
+        """
+        执行流水线, 最后一个阶段在当前线程执行.
+        最后阶段返回 False 时停止流水线, 任一阶段异常时停止并向上抛出.
+        """
+        queues = [queue.Queue(maxsize=self.maxsize) for _ in self.stages]
+        self._threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for idx, func in enumerate(self.stages[:-1]):
+            self._threads.append(threading.Thread(target=self._work, args=(func, queues[idx], queues[idx + 1]),
+                                                  daemon=True))
+        for t in self._threads:
+            t.start()
+
+        sink, sink_q = self.stages[-1], queues[-1]
+        try:
+            while True:
+                item = self._get(sink_q)
+                if item is _STOP:
+                    break
+                if isinstance(item, _StageError):
+                    raise item.error
+                if sink(item) is False:
+                    break
+        finally:
+            self.stop()
+            for t in self._threads:
+                t.join()
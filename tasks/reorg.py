@@ -0,0 +1,72 @@
+"""
+分叉检测
+
+内存中保存最近若干块的 (height, hash), 每个新块都用 parentHash 与前一块校验连续性,
+不连续即说明链发生了重组, 由扫链程序回滚后重新扫描.
+"""
+from collections import deque
+
+from exceptions import SyncError
+
+
+class ReorgError(SyncError):
+    """链重组, height 为 parentHash 不连续的块高度"""
+
+    def __init__(self, height, parent_hash, local_hash):
+        self.height = height
+        self.parent_hash = parent_hash
+        self.local_hash = local_hash
+        super().__init__('高度 {} 发生重组, parentHash: {} 本地: {}'.format(height, parent_hash, local_hash))
+
+
+class BlockHashRing(object):
+    """固定长度的最近块 hash 环形缓冲"""
+
+    def __init__(self, size=128):
+        self.size = size
+        self._ring = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._ring)
+
+    def load(self, pairs):
+        """从数据库加载, pairs: iterable<tuple<height, hash>>, 按高度升序"""
+        self._ring.clear()
+        for height, block_hash in pairs:
+            self._ring.append((height, block_hash.lower()))
+
+    def get(self, height):
+        if not self._ring:
+            return None
+        offset = height - self._ring[0][0]
+        if 0 <= offset < len(self._ring) and self._ring[offset][0] == height:
+            return self._ring[offset][1]
+        for h, block_hash in self._ring:
+            if h == height:
+                return block_hash
+        return None
+
+    @property
+    def lowest(self):
+        return self._ring[0][0] if self._ring else None
+
+    @property
+    def highest(self):
+        return self._ring[-1][0] if self._ring else None
+
+    def check(self, height, block_hash, parent_hash):
+        """
+        校验并追加一个块, 与前一块不连续时抛出 ReorgError.
+        缓冲为空或前一块不在缓冲中(如跳高度)时不校验.
+        """
+        local_parent = self.get(height - 1)
+        if local_parent is not None and local_parent != parent_hash.lower():
+            raise ReorgError(height, parent_hash, local_parent)
+        if self._ring and self._ring[-1][0] >= height:
+            self.rewind(height)
+        self._ring.append((height, block_hash.lower()))
+
+    def rewind(self, height):
+        """丢弃高度 >= height 的记录"""
+        while self._ring and self._ring[-1][0] >= height:
+            self._ring.pop()
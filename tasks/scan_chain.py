@@ -1,30 +1,119 @@
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta
+import json
+import os
+import socket
+import threading
+import time
 import uuid
-import requests
 
-from blue_print.v1.controller import check_passphrase, get_secret
+from blue_print.v1.controller import check_hot_wallet, get_secret
 from coin.resolver.eth_resolver import EthereumResolver
 
 from digit import digit
 from digit.digit import hex_to_int
 from enumer.coin_enum import SendEnum, TxTypeEnum, TxStatusEnum
-from exceptions import SyncError, PasswordError
-from models.models import Coin, Address, Transaction, RpcConfig, ProjectCoin, ProjectOrder, SyncConfig, Block, Project
+from exceptions import SyncError
+from models.models import Coin, Address, Transaction, RpcConfig, ProjectCoin, ProjectOrder, SyncConfig, Block, Project, \
+    ScanLease, NotifyQueue
 from exts import db
 from config import runtime
+from config.address_index import AddressIndex
 from config.config import config
 from log import logger_attr
+from middleware.auth import order_data
+from sign.sign import sign_data
+from tasks.batch_size import AdaptiveBatchSize
+from tasks.block_archive import get_archive
+from tasks.eth_rpc import EthBatchRpc, TRANSFER_TOPIC, TRANSFER_SELECTOR, TRANSFER_FROM_SELECTOR
+from tasks.head_watcher import HeadWatcher
+from tasks.metrics import BatchMetrics, scan_metrics
+from tasks.notify import Notification, get_dispatcher, signal_outbox, wait_outbox
+from tasks.pipeline import Pipeline
+from tasks.reorg import BlockHashRing, ReorgError
+
+
+# 拉取阶段保留的块头, 用于重组检测及 Block 表
+BlockHeader = namedtuple('BlockHeader', ['height', 'hash', 'parent_hash', 'timestamp'])
+# 单个块拉取后保留的数据: 块头, 命中的充值交易, 交易数, 待归档的压缩原始块
+BlockSummary = namedtuple('BlockSummary', ['header', 'matched', 'tx_count', 'record'])
+
+
+class LeaseInfo(object):
+    """当前持有的租约, 脱离 session 使用"""
+
+    def __init__(self, lease_id, start_height, end_height):
+        self.id = lease_id
+        self.start_height = start_height
+        self.end_height = end_height
+
+
+class ScanBatch(object):
+    """流水线中传递的一批块"""
+
+    def __init__(self, height, block_batch):
+        self.height = height
+        self.block_batch = block_batch
+        self.end_height = height + block_batch
+        # list<BlockHeader>, 按高度排列
+        self.headers = []
+        # list<tuple<tx, coin, hex_height, height, timestamp>>, 拉取时已从块中匹配的充值交易
+        self.matched = []
+        # logs 模式下该批次的 Transfer 日志
+        self.logs = []
+        # list<dict>, Block 表字段
+        self.blocks = []
+        # list<dict>, Transaction.add_transaction_or_update 入参
+        self.txs = []
+        # 各阶段耗时及数量
+        self.metrics = BatchMetrics()
+        # list<tuple<height, 压缩的原始块>>, 入库后写入本地归档
+        self.archive_records = None
 
 
 @logger_attr
 class ScanEthereumChain(object):
     """扫链"""
     COIN_NAME = 'Ethereum'
+    # 地址增量同步间隔秒数及每次查询条数
+    ADDRESS_SYNC_SECONDS = 5
+    ADDRESS_SYNC_PAGE = 10000
+    # 项目增量同步间隔秒数, 及按 update_time 回看的秒数
+    PROJECT_SYNC_SECONDS = 5
+    PROJECT_SYNC_LAG = 60
+    # 项目全量重新加载间隔秒数, 淘汰已删除的项目及项目币种
+    PROJECT_RELOAD_SECONDS = 600
+    # 初始批量块数, 之后在 [SCAN_BATCH_MIN, SCAN_BATCH_MAX] 内按实际耗时调整
     SCAN_HEIGHT_NUMBER = 50
+    SCAN_BATCH_MIN = 1
+    SCAN_BATCH_MAX = 500
+    # 每批目标耗时, 秒
+    SCAN_BATCH_TARGET_SECONDS = 2.0
+    # 拉取块失败时缩小批量重试的次数
+    FETCH_RETRY = 3
     SCAN_DELAY_NUMBER = 12
+    # 预取批次数, 即流水线各阶段之间队列的长度
+    SCAN_PREFETCH_NUMBER = 2
+    # 单个块内命中的充值交易达到该数量时, 使用 eth_getBlockReceipts 整块获取 receipt
+    BLOCK_RECEIPTS_THRESHOLD = 20
+    # 拉取块后丢弃的交易字段, 解析充值不需要签名等数据
+    PRUNE_TX_FIELDS = ('v', 'r', 's', 'yParity', 'accessList', 'blobVersionedHashes', 'authorizationList')
+    # 扫链模式, block: 拉取完整块解析全部交易; logs: 代币充值使用 eth_getLogs 过滤 Transfer 日志
+    SCAN_MODE_BLOCK = 'block'
+    SCAN_MODE_LOGS = 'logs'
+    # 保存最近块 hash 的数量, 即可处理的最大重组深度
+    REORG_RING_SIZE = 128
+    # 一次扫链中最多处理的重组次数
+    MAX_REORG_RETRY = 3
+    # 分片扫链每个租约的区间大小及有效秒数
+    SCAN_LEASE_SIZE = 1000
+    SCAN_LEASE_TTL = 600
+    # 常驻扫链的轮询间隔, 订阅新块时为订阅断开后的兜底间隔
+    SCAN_POLL_SECONDS = 3
 
     def __init__(self):
         self.rpc = None
+        self.batch_rpc = None
         self.current_scan_height = None
         self.newest_height = None
         self.highest_height = None
@@ -32,6 +121,36 @@ class ScanEthereumChain(object):
         self.block_info = None
         self.db_sync_info = None
         self.config_id = None
+        self.coin_id = None
+
+        # 分片扫链, 当前持有的租约
+        self.lease = None
+        self.worker_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.lease_size = getattr(config, 'SCAN_LEASE_SIZE', self.SCAN_LEASE_SIZE)
+        self.lease_ttl = getattr(config, 'SCAN_LEASE_TTL', self.SCAN_LEASE_TTL)
+
+        # 需要匹配的充值地址及代币合约, 合约为 None 时匹配 runtime.coins 中的全部代币
+        self.watch_address = runtime.project_address
+        self.watch_contracts = None
+        # 是否检测重组及推进 SyncConfig 同步高度, 历史补扫时关闭
+        self.check_reorg = True
+        self.update_cursor = True
+
+        # 本地原始块归档, 未配置时为 None
+        self.archive = get_archive()
+        self.batch_size = AdaptiveBatchSize(
+            getattr(config, 'SCAN_HEIGHT_NUMBER', self.SCAN_HEIGHT_NUMBER),
+            getattr(config, 'SCAN_BATCH_MIN', self.SCAN_BATCH_MIN),
+            getattr(config, 'SCAN_BATCH_MAX', self.SCAN_BATCH_MAX),
+            target_seconds=getattr(config, 'SCAN_BATCH_TARGET_SECONDS', self.SCAN_BATCH_TARGET_SECONDS))
+
+        self.scan_delay = getattr(config, 'SCAN_DELAY_NUMBER', self.SCAN_DELAY_NUMBER)
+        # 扫描到最新块, 未达到延迟块数的充值以未确认入库, 之后由 confirm_deposits 确认或丢弃
+        self.scan_to_tip = getattr(config, 'SCAN_TO_TIP', False)
+        self.block_ring = BlockHashRing(getattr(config, 'REORG_RING_SIZE', self.REORG_RING_SIZE))
+        self.scan_mode = getattr(config, 'SCAN_MODE', self.SCAN_MODE_BLOCK)
+        # logs 模式下是否仍扫描主链币充值, 不扫描时只拉取块头
+        self.scan_native = getattr(config, 'SCAN_NATIVE', True)
 
         self._init()
 
@@ -40,6 +159,8 @@ class ScanEthereumChain(object):
             self.rpc = RpcConfig.get_rpc()
             if self.rpc is None:
                 raise SyncError('未找到需要定义的RPC')
+            self.batch_rpc = EthBatchRpc(RpcConfig.get_rpc_config().host,
+                                         timeout=getattr(config, 'RPC_TIMEOUT', None))
 
             self.block_info = self.rpc.get_block_height()
             self.db_sync_info = SyncConfig.get_sync_info(self.COIN_NAME)
@@ -47,17 +168,68 @@ class ScanEthereumChain(object):
                 raise SyncError('未找到需要定义的RPC')
             self.current_scan_height = self.db_sync_info.SyncConfig.synced_height
             self.config_id = self.db_sync_info.SyncConfig.id
+            self.coin_id = self.db_sync_info.SyncConfig.coin_id
+            self.block_ring.load(Block.get_recent_hashes(self.current_scan_height, self.block_ring.size))
 
     @classmethod
     def read_address(cls):
+        cls.sync_address(force=True)
+
+    @classmethod
+    def sync_address(cls, force=False):
+        """
+        增量同步地址, 读取 id 大于已同步最大 id 的地址.
+        其他进程(如 web worker)新生成的地址通过此方式在 ADDRESS_SYNC_SECONDS 内可见
+        """
+        index = runtime.project_address
+        interval = getattr(config, 'ADDRESS_SYNC_SECONDS', cls.ADDRESS_SYNC_SECONDS)
+        if not force and time.time() - index.synced_at < interval:
+            return 0
+        index.synced_at = time.time()
+        count = 0
         with runtime.app.app_context():
-            addresses = Address.get_coin_address_by_coin_name(cls.COIN_NAME)
-            for address in addresses:
-                runtime.project_address.update({address[0]: {'project_id': address[1],
-                                                             'coin_id': address[2],
-                                                             'coin_name': address[3],
-                                                             }
-                                                })
+            while True:
+                rows = Address.get_coin_address_after_id(cls.COIN_NAME, index.last_id, cls.ADDRESS_SYNC_PAGE)
+                if not rows:
+                    break
+                index.load((row[1:] for row in rows), merge=False)
+                index.last_id = rows[-1][0]
+                count += len(rows)
+                if len(rows) < cls.ADDRESS_SYNC_PAGE:
+                    break
+        if force:
+            index.merge()
+        else:
+            index.maybe_merge()
+        if count:
+            cls.logger.info('同步新增地址 {} 个, 当前地址总数 {}'.format(count, len(index)))
+        return count
+
+    @classmethod
+    def sync_projects(cls, force=False):
+        """
+        增量同步项目及项目币种到 runtime.project, 读取 update_time 不早于已同步最大 update_time 的记录.
+        update_time 由写入进程生成, 提交可能晚于生成时间, 每次多回看 PROJECT_SYNC_LAG 秒.
+        增量同步无法发现删除, 每 PROJECT_RELOAD_SECONDS 秒全量重新加载一次
+        """
+        registry = runtime.project
+        interval = getattr(config, 'PROJECT_SYNC_SECONDS', cls.PROJECT_SYNC_SECONDS)
+        now = time.time()
+        if not force and now - registry.synced_at < interval:
+            return 0
+        registry.synced_at = now
+        full = now - registry.reloaded_at >= getattr(config, 'PROJECT_RELOAD_SECONDS', cls.PROJECT_RELOAD_SECONDS)
+        if full:
+            registry.reloaded_at = now
+        lag = timedelta(seconds=cls.PROJECT_SYNC_LAG)
+        with runtime.app.app_context():
+            since = None if full else registry.project_updated and registry.project_updated - lag
+            count = registry.load_projects(Project.get_projects_updated_since(since), full=full)
+            since = None if full else registry.coin_updated and registry.coin_updated - lag
+            count += registry.load_project_coins(ProjectCoin.get_pro_coins_updated_since(since), full=full)
+        if count:
+            cls.logger.info('同步项目及项目币种变化 {} 条'.format(count))
+        return count
 
     @classmethod
     def read_coins(cls):
@@ -77,101 +249,598 @@ class ScanEthereumChain(object):
         self.block_info = self.rpc.get_block_height()
         self.newest_height = self.block_info.current_height
         self.highest_height = self.block_info.highest_height
-        # 延迟扫 SCAN_DELAY_NUMBER 个块
-        need_to_height = self.newest_height - self.SCAN_DELAY_NUMBER
-        self.logger.info('起始扫块高度：{} 最新高度：{} 需要同步：{}'.format(
+        if self.scan_to_tip:
+            need_to_height = self.newest_height + 1
+        else:
+            # 延迟扫 scan_delay 个块
+            need_to_height = self.newest_height - self.scan_delay
+        self.logger.info('起始扫块高度：{} 最新高度：{} 需要同步：{}  节点最高高度：{}'.format(
             self.current_scan_height,
             self.newest_height,
-            need_to_height - self.current_scan_height))
-        while self.current_scan_height < need_to_height:
-            self.logger.info('当前已扫块高度：{} 最新高度：{} 需要同步：{}  节点最高高度：{}'.format(
-                self.current_scan_height, self.newest_height,
-                need_to_height - self.current_scan_height,
-                self.highest_height))
-
-            for height in range(self.current_scan_height, need_to_height, self.SCAN_HEIGHT_NUMBER):
-                # 分批处理, 一次处理 SCAN_HEIGHT_NUMBER 或 剩余要处理的块
-                block_batch = min(self.SCAN_HEIGHT_NUMBER, need_to_height - self.current_scan_height)
-
-                blocks = self.rpc.get_block_by_number([digit.int_to_hex(height) for height in
-                                                       range(height, height + block_batch)])
-                save_tx_count = 0
-                with runtime.app.app_context():
-                    # 一次处理一批
-                    session = db.session()
+            need_to_height - self.current_scan_height,
+            self.highest_height))
+
+        for _ in range(self.MAX_REORG_RETRY + 1):
+            # 拉取 -> 解析 -> 入库 流水线, 入库在当前线程按高度顺序提交
+            pipeline = Pipeline([self.fetch_blocks, self.resolve_blocks, self.persist_blocks],
+                                maxsize=getattr(config, 'SCAN_PREFETCH_NUMBER', self.SCAN_PREFETCH_NUMBER))
+            scan_metrics.start()
+            try:
+                pipeline.run(self.iter_batches(need_to_height))
+            except ReorgError as e:
+                self.logger.warning('{}, 开始回滚'.format(e))
+                try:
+                    self.rollback(e.height)
+                except Exception as re:
+                    self.logger.error('重组回滚失败, 本次扫链结束. {}'.format(re))
+                    return
+                continue
+            except Exception as e:
+                self.logger.error('同步块出现异常, 本次扫链结束. {}'.format(e))
+                return
+            break
+        if self.scan_to_tip:
+            try:
+                self.confirm_deposits()
+            except Exception as e:
+                self.logger.error('确认充值出现异常. {}'.format(e))
+        self.logger.info("扫链结束, 本次同步至：{}".format(self.current_scan_height))
+
+    def confirm_deposits(self):
+        """
+        确认跟踪: 未确认充值达到 scan_delay 个确认后, 与节点当前块 hash 比对,
+        一致则确认, 不一致说明所在块已被重组, 标记为丢弃
+        """
+        with runtime.app.app_context():
+            pending = Transaction.get_unconfirmed_deposits(self.newest_height - self.scan_delay)
+            if not pending:
+                return
+            heights = sorted({height for _, height, _ in pending})
+            blocks, _ = self.batch_rpc.get_blocks(heights, False)
+            node_hashes = {height: block['hash'].lower() for height, block in zip(heights, blocks) if block}
+            confirmed, dropped = [], []
+            for tx_id, height, block_hash in pending:
+                node_hash = node_hashes.get(height)
+                if node_hash is None:
+                    # 未获取到块, 下次再确认
+                    continue
+                if node_hash == (block_hash or '').lower():
+                    confirmed.append(tx_id)
+                else:
+                    dropped.append(tx_id)
+            session = db.session()
+            try:
+                Transaction.confirm_deposits(confirmed, commit=False, session=session)
+                Transaction.drop_deposits(dropped, commit=False, session=session)
+                enqueued = NotifyQueue.enqueue_pending(confirmed + dropped, session=session)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+        if enqueued:
+            signal_outbox()
+        self.logger.info('确认充值 {} 笔, 被重组丢弃 {} 笔'.format(len(confirmed), len(dropped)))
+
+    def scan_sharded(self):
+        """
+        分片扫链, 每次租用一个高度区间独立扫描提交, 多个进程或主机可同时运行.
+        连续完成的区间合并为 SyncConfig.synced_height 安全高度.
+        """
+        self.block_info = self.rpc.get_block_height()
+        self.newest_height = self.block_info.current_height
+        self.highest_height = self.block_info.highest_height
+        need_to_height = self.newest_height - self.scan_delay
+
+        while True:
+            with runtime.app.app_context():
+                synced_height = SyncConfig.get_sync_info(self.COIN_NAME).SyncConfig.synced_height
+                lease = ScanLease.acquire(self.coin_id, self.worker_id, synced_height, need_to_height,
+                                          self.lease_size, self.lease_ttl)
+                if lease is None:
+                    break
+                self.lease = LeaseInfo(lease.id, lease.start_height, lease.end_height)
+                self.current_scan_height = lease.scanned_height
+                self.block_ring.load(Block.get_recent_hashes(self.current_scan_height, self.block_ring.size))
+            self.logger.info('{} 租用区间 {} -- {}, 已同步至 {}'.format(
+                self.worker_id, self.lease.start_height, self.lease.end_height, self.current_scan_height))
+
+            pipeline = Pipeline([self.fetch_blocks, self.resolve_blocks, self.persist_blocks],
+                                maxsize=getattr(config, 'SCAN_PREFETCH_NUMBER', self.SCAN_PREFETCH_NUMBER))
+            scan_metrics.start()
+            try:
+                pipeline.run(self.iter_batches(self.lease.end_height))
+            except ReorgError as e:
+                if e.height - 1 < self.lease.start_height:
+                    # 分叉点在区间之下, 只清理本区间无法恢复, 回滚分叉点以上的全部数据及租约
+                    self.logger.warning('{}, 分叉点低于租约 {} 起始高度, 全局回滚'.format(e, self.lease.id))
                     try:
-                        for block in blocks:
-                            if block is None:
-                                return
-                            block_height = digit.hex_to_int(block['number'])
-                            block_hash = block['hash']
-                            block_timestamp = digit.hex_to_int(block['timestamp'])
-                            block_time = datetime.fromtimestamp(block_timestamp)
-
-                            session.begin(subtransactions=True)
-                            db_block = Block(height=block_height, block_hash=block_hash, block_time=block_time)
-                            session.add(db_block)
-                            session.commit()
-
-                            for transaction in block.get('transactions', []):
-                                tx = EthereumResolver.resolver_transaction(transaction)
-                                if tx.sender in runtime.project_address:
-                                    # 提现的暂时不要
-                                    continue
-                                if tx.receiver in runtime.project_address:
-                                    receipt_raw_tx = self.rpc.get_transaction_receipt(tx.tx_hash)
-                                    if tx.contract:
-                                        coin = runtime.coins.get(tx.contract)
-                                    else:
-                                        coin = runtime.coins.get(self.COIN_NAME)
-                                    if coin is None:
-                                        continue
-
-                                    if receipt_raw_tx:
-                                        receipt_tx = EthereumResolver.resolver_receipt(receipt_raw_tx)
-                                    else:
-                                        self.logger.error('请求 {} receipt 错误, 重新处理')
-                                        raise
-                                    tx.status = receipt_tx.status
-                                    # session.begin(subtransactions=True)
-                                    # db_tx = Transaction(block_id=db_block.id, coin_id=coin['coin_id'],
-                                    #                     tx_hash=tx.tx_hash, height=db_block.height,
-                                    #                     block_time=block_timestamp,
-                                    #                     amount=tx.value, sender=tx.sender, receiver=tx.receiver,
-                                    #                     gas=tx.gas, gas_price=tx.gas_price,
-                                    #                     is_send=SendEnum.NOT_PUSH.value,
-                                    #                     fee=receipt_tx.gas_used * tx.gas_price,
-                                    #                     contract=tx.contract, status=receipt_tx.status,
-                                    #                     type=TxTypeEnum.DEPOSIT.value)
-                                    Transaction.add_transaction_or_update(
-                                        block_id=db_block.id, coin_id=coin['coin_id'],
-                                        tx_hash=tx.tx_hash, height=db_block.height,
-                                        block_time=block_timestamp,
-                                        amount=tx.value, sender=tx.sender, receiver=tx.receiver,
-                                        gas=tx.gas, gas_price=tx.gas_price,
-                                        is_send=SendEnum.NOT_PUSH.value,
-                                        fee=receipt_tx.gas_used * tx.gas_price,
-                                        contract=tx.contract, status=receipt_tx.status,
-                                        type=TxTypeEnum.DEPOSIT.value, session=session, commit=False
-                                    )
-                                    save_tx_count += 1
-                                    # session.add(db_tx)
-                                    # session.commit()
-                                    # 添加推送信息
+                        self.rollback(e.height)
+                    except Exception as err:
+                        self.logger.error('重组回滚出现异常, 释放租约 {}. {}'.format(self.lease.id, err))
+                        with runtime.app.app_context():
+                            ScanLease.release(self.lease.id, self.worker_id)
+                    break
+                # 区间内数据清理后交给下次重新租用
+                self.logger.warning('{}, 放弃租约 {}'.format(e, self.lease.id))
+                with runtime.app.app_context():
+                    ScanLease.abandon(self.lease.id, self.worker_id)
+                if self.archive is not None:
+                    self.archive.invalidate(self.lease.start_height, self.lease.end_height)
+                break
+            except Exception as e:
+                self.logger.error('分片同步出现异常, 租约 {} 到期后由其他进程接手. {}'.format(self.lease.id, e))
+                break
+            if self.current_scan_height < self.lease.end_height:
+                # 节点暂未返回区间内的块, 释放租约保留进度
+                with runtime.app.app_context():
+                    ScanLease.release(self.lease.id, self.worker_id)
+                break
+
+            with runtime.app.app_context():
+                ScanLease.complete(self.lease.id, self.worker_id)
+                safe_height = ScanLease.advance_watermark(self.coin_id, self.config_id)
+            self.logger.info('租约 {} 完成, 安全高度：{}'.format(self.lease.id, safe_height))
+        self.lease = None
+        self.logger.info("分片扫链结束")
+
+    def follow(self, stop_event=None):
+        """
+        常驻扫链, 配置 RPC_WS_URL 时订阅新块, 新块到达后立即扫描;
+        未配置或订阅断开时按 SCAN_POLL_SECONDS 轮询
+        :param stop_event: threading.Event, 设置后退出
+        """
+        stop_event = stop_event or threading.Event()
+        poll_seconds = getattr(config, 'SCAN_POLL_SECONDS', self.SCAN_POLL_SECONDS)
+        ws_url = getattr(config, 'RPC_WS_URL', None)
+        watcher = None
+        if ws_url:
+            watcher = HeadWatcher(ws_url)
+            watcher.start()
+        self.logger.info('常驻扫链开始, 新块通知：{}'.format(ws_url or '轮询'))
+        try:
+            while not stop_event.is_set():
+                try:
+                    self.sync_address()
+                    if getattr(config, 'SCAN_SHARDED', False):
+                        self.scan_sharded()
+                    else:
+                        self.scan()
+                except Exception as e:
+                    self.logger.error('常驻扫链出现异常, 等待下次扫描. {}'.format(e))
+                if watcher is not None:
+                    watcher.wait(poll_seconds)
+                else:
+                    stop_event.wait(poll_seconds)
+        finally:
+            if watcher is not None:
+                watcher.stop()
+        self.logger.info('常驻扫链结束')
+
+    def iter_batches(self, need_to_height):
+        """分批处理, 一次处理自适应批量大小或剩余要处理的块"""
+        height = self.current_scan_height
+        while height < need_to_height:
+            block_batch = min(self.batch_size.size, need_to_height - height)
+            yield height, block_batch
+            height += block_batch
+
+    def find_fork_height(self, height):
+        """自 height - 1 向下比对本地与节点的块 hash, 返回最后一个相同的高度"""
+        lowest = self.block_ring.lowest
+        for h in range(height - 1, (lowest or height) - 1, -1):
+            local_hash = self.block_ring.get(h)
+            if local_hash is None:
+                break
+            node_block = self.rpc.get_block_by_number(digit.int_to_hex(h), False)
+            if node_block and node_block['hash'].lower() == local_hash:
+                return h
+        raise SyncError('重组深度超过 {} 个块, 需要人工处理'.format(len(self.block_ring)))
+
+    def rollback(self, height):
+        """回滚分叉点以上的块及充值交易, 并将同步高度退回分叉点"""
+        fork_height = self.find_fork_height(height)
+        # 分叉点在尚未入库的范围内时, 数据库无需回滚
+        rewind_height = min(fork_height + 1, self.current_scan_height)
+        with runtime.app.app_context():
+            session = db.session()
+            try:
+                deleted_blocks = Block.delete_from_height(rewind_height, session=session)
+                # 未确认充值标记为丢弃, 已确认的删除
+                dropped_txs = Transaction.drop_deposits(height=rewind_height, commit=False, session=session)
+                deleted_txs, pushed_txs = Transaction.delete_deposit_from_height(rewind_height, session=session)
+                enqueued = NotifyQueue.enqueue_pending(min_height=rewind_height, session=session)
+                sync_query = session.query(SyncConfig).filter(SyncConfig.id == self.config_id)
+                if self.lease is not None:
+                    # 分片模式: 删除分叉点以上的租约, 安全高度只降不升
+                    ScanLease.rewind(self.coin_id, rewind_height, session=session)
+                    sync_query = sync_query.filter(SyncConfig.synced_height > rewind_height)
+                sync_query.update({'synced_height': rewind_height})
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+        if enqueued:
+            signal_outbox()
+        self.block_ring.rewind(rewind_height)
+        if self.archive is not None:
+            self.archive.invalidate(rewind_height)
+        self.current_scan_height = rewind_height
+        self.logger.warning('重组回滚至高度 {}, 删除块 {} 个, 充值交易 {} 笔, 丢弃未确认充值 {} 笔'.format(
+            rewind_height, deleted_blocks, deleted_txs, dropped_txs))
+        if pushed_txs:
+            self.logger.error('重组回滚的充值交易中有 {} 笔已推送给项目方, 需要人工核对'.format(pushed_txs))
+
+    def flush_archive(self):
+        """归档已达到确认数的块, 扫描到最新块时未确认的块暂存在归档对象中, 归档失败不影响扫链"""
+        try:
+            self.archive.flush(self.newest_height - self.scan_delay)
+        except Exception as e:
+            self.logger.warning('归档失败: {}'.format(e))
+
+    @property
+    def use_logs(self):
+        return self.scan_mode == self.SCAN_MODE_LOGS
+
+    def token_contracts(self):
+        """需要匹配的代币合约, dict<contract(小写), coin>"""
+        contracts = {coin['contract'].lower(): coin for coin in runtime.coins.values() if coin['contract']}
+        if self.watch_contracts is None:
+            return contracts
+        return {contract: coin for contract, coin in contracts.items() if contract in self.watch_contracts}
+
+    def prune_transaction(self, transaction, contracts):
+        """
+        裁剪解析不需要的交易字段, 交易解码后立即调用以降低内存占用
+        :param contracts: set<contract(小写)>, 发往这些合约的交易保留 input
+        """
+        for field in self.PRUNE_TX_FIELDS:
+            transaction.pop(field, None)
+        if (transaction.get('to') or '').lower() not in contracts:
+            transaction['input'] = '0x'
+        return transaction
+
+    def is_candidate(self, transaction, contracts):
+        """
+        解析前的快速过滤, 只看原始交易的 to 及代币转账 calldata 中的收款地址,
+        不可能是充值的交易不进入 resolver_transaction
+        :param contracts: set<contract(小写)>, 已知代币合约
+        """
+        to = transaction.get('to')
+        if not to:
+            # 创建合约
+            return False
+        if to in self.watch_address:
+            return True
+        if to.lower() not in contracts:
+            return False
+        data = transaction.get('input') or ''
+        selector = data[:10]
+        if selector == TRANSFER_SELECTOR:
+            # 第一个参数为收款地址, 32 字节左补零
+            receiver = data[34:74]
+        elif selector == TRANSFER_FROM_SELECTOR:
+            receiver = data[98:138]
+        else:
+            return False
+        return receiver in self.watch_address
+
+    def fetch_blocks(self, batch):
+        """
+        拉取阶段: 从节点获取一批块, logs 模式下同时获取代币 Transfer 日志.
+        每个块解码后立即匹配充值交易, 只保留块头及命中的交易, 开启归档时保留压缩的原始字节.
+        请求出错或有空块时缩小批量分段重试, 多次失败视为已到节点最新高度
+        """
+        height, block_batch = batch
+        end_height = height + block_batch
+        full_tx = not self.use_logs or self.scan_native
+        scan_batch = ScanBatch(height, block_batch)
+        metrics = scan_batch.metrics
+        archive = full_tx and self.archive is not None
+        contracts = self.token_contracts()
+        # logs 模式下代币交易由日志处理
+        log_contracts = contracts if self.use_logs else {}
+        known_contracts = {coin['contract'].lower() for coin in runtime.coins.values() if coin['contract']}
+        prune = (lambda transaction: self.prune_transaction(transaction, known_contracts)) if full_tx else None
+
+        def reduce(block, data):
+            return self.reduce_block(block, data if archive else None, full_tx, log_contracts, known_contracts,
+                                     metrics)
+
+        summaries, h, retry = [], height, 0
+        while h < end_height:
+            size = min(self.batch_size.size, end_height - h)
+            if self.archive is not None and self.archive.contains(h, h + size):
+                # 归档中的块已过确认深度, 不再重复归档
+                metrics.incr('archive_blocks', size)
+                summaries.extend(self.reduce_block(self.archive.get(archived), None, full_tx, log_contracts,
+                                                   known_contracts, metrics) for archived in range(h, h + size))
+                h += size
+                continue
+            start_time = time.time()
+            try:
+                chunk, nbytes = self.batch_rpc.get_blocks(range(h, h + size), full_tx, prune, reduce)
+            except Exception as e:
+                self.logger.warning('获取高度 {} -- {} 出现异常: {}'.format(h, h + size, e))
+                chunk, nbytes = None, 0
+            metrics.incr('rpc_fetch_seconds', time.time() - start_time)
+            if not chunk or any(summary is None for summary in chunk):
+                self.batch_size.backoff()
+                retry += 1
+                if retry > self.FETCH_RETRY:
+                    self.logger.warning('高度 {} -- {} 存在未获取到的块, 等待下次同步'.format(h, h + size))
+                    return None
+                continue
+            self.batch_size.record(size, time.time() - start_time, nbytes, sum(summary.tx_count for summary in chunk))
+            metrics.incr('bytes_received', nbytes)
+            summaries.extend(chunk)
+            h += size
+
+        scan_batch.headers = [summary.header for summary in summaries]
+        for summary in summaries:
+            scan_batch.matched.extend(summary.matched)
+        if archive:
+            scan_batch.archive_records = [(summary.header.height, summary.record)
+                                          for summary in summaries if summary.record is not None]
+        metrics['blocks'] = len(summaries)
+        if self.use_logs and contracts:
+            with metrics.timer('rpc_fetch_seconds'):
+                scan_batch.logs = self.batch_rpc.get_logs(height, end_height - 1, list(contracts),
+                                                          [TRANSFER_TOPIC])
+        return scan_batch
+
+    def reduce_block(self, block, data, full_tx, contracts, known_contracts, metrics):
+        """
+        块解码后立即调用, 只保留块头及命中的充值交易, 完整块随即释放
+        :param data: 该块响应元素的原始字节, 压缩后待归档, None 为不归档
+        :param contracts: dict<contract(小写), coin>, 由日志处理的代币合约, 发往这些合约的交易跳过
+        :param known_contracts: set<contract(小写)>, 已知代币合约
+        :return: BlockSummary
+        """
+        header = BlockHeader(digit.hex_to_int(block['number']), block['hash'], block['parentHash'],
+                             digit.hex_to_int(block['timestamp']))
+        transactions = block.get('transactions', [])
+        matched = []
+        for transaction in transactions if full_tx else []:
+            if not isinstance(transaction, dict):
+                # 只拉取了块头, 交易仅有 hash
+                break
+            if contracts and (transaction.get('to') or '').lower() in contracts:
+                continue
+            metrics.incr('txs_resolved')
+            if not self.is_candidate(transaction, known_contracts):
+                continue
+            metrics.incr('txs_candidate')
+            tx = EthereumResolver.resolver_transaction(transaction)
+            if tx.sender in runtime.project_address:
+                # 提现的暂时不要
+                continue
+            if tx.receiver not in self.watch_address:
+                continue
+            if self.watch_contracts is not None:
+                # 指定合约补扫时, 块内其它代币及未要求的主链币转账不入库
+                if tx.contract:
+                    if tx.contract.lower() not in self.watch_contracts:
+                        continue
+                elif not self.scan_native:
+                    continue
+            if tx.contract:
+                coin = runtime.coins.get(tx.contract)
+            else:
+                coin = runtime.coins.get(self.COIN_NAME)
+            if coin is None:
+                continue
+            matched.append((tx, coin, block['number'], header.height, header.timestamp))
+        record = self.archive.pack(data) if data is not None else None
+        return BlockSummary(header, matched, len(transactions), record)
+
+    def resolve_blocks(self, batch):
+        """解析阶段: 检测重组, 匹配日志中的代币充值, 并批量获取命中交易的 receipt"""
+        start_time = time.time()
+        metrics = batch.metrics
+        contracts = self.token_contracts() if self.use_logs else {}
+        block_timestamps, block_hashes = {}, {}
+        for header in batch.headers:
+            block_timestamps[header.height] = header.timestamp
+            block_hashes[header.height] = header.hash
+            if self.check_reorg:
+                self.block_ring.check(header.height, header.hash, header.parent_hash)
+            batch.blocks.append({
+                "height": header.height,
+                "block_hash": header.hash,
+                "block_time": datetime.fromtimestamp(header.timestamp),
+            })
+        matched, batch.matched = batch.matched, None
 
+        if batch.logs:
+            matched.extend(self.match_logs(batch.logs, contracts, block_timestamps, metrics))
+            batch.logs = None
+
+        metrics['deposits_matched'] = len(matched)
+        with metrics.timer('receipt_fetch_seconds'):
+            receipts = self.fetch_receipts(matched)
+        # 扫描到最新块时, 未达到延迟块数的充值为未确认
+        confirmed_height = self.newest_height - self.scan_delay if self.scan_to_tip else None
+        for tx, coin, _, block_height, block_timestamp in matched:
+            receipt_raw_tx = receipts.get(tx.tx_hash.lower())
+            if not receipt_raw_tx:
+                raise SyncError('请求 {} receipt 错误, 重新处理'.format(tx.tx_hash))
+            receipt_tx = EthereumResolver.resolver_receipt(receipt_raw_tx)
+            tx.status = receipt_tx.status
+            unconfirmed = confirmed_height is not None and block_height >= confirmed_height
+            batch.txs.append({
+                "coin_id": coin['coin_id'], "tx_hash": tx.tx_hash, "height": block_height,
+                "block_time": block_timestamp, "amount": tx.value, "sender": tx.sender,
+                "receiver": tx.receiver, "gas": tx.gas, "gas_price": tx.gas_price,
+                "is_send": SendEnum.NOT_PUSH.value, "fee": receipt_tx.gas_used * tx.gas_price,
+                "contract": tx.contract, "status": receipt_tx.status,
+                "tx_type": TxTypeEnum.DEPOSIT.value, "block_hash": block_hashes.get(block_height),
+                "confirm_status": Transaction.UNCONFIRMED if unconfirmed else Transaction.CONFIRMED,
+                "seen_send": SendEnum.NOT_PUSH.value if unconfirmed else SendEnum.NEEDLESS.value,
+            })
+        metrics['resolve_seconds'] = time.time() - start_time
+        return batch
+
+    def match_logs(self, logs, contracts, block_timestamps, metrics):
+        """
+        从 Transfer 日志中匹配充值, indexed to 为本钱包地址即命中,
+        命中的交易批量获取交易详情用于 gas 信息
+        :return: list<tuple<tx, coin, hex_height, height, timestamp>>
+        """
+        hits, seen = [], set()
+        for log in logs:
+            topics = log.get('topics') or []
+            # ERC721 的 Transfer 有 4 个 topic, 不处理
+            if log.get('removed') or len(topics) != 3:
+                continue
+            sender, receiver = '0x' + topics[1][-40:].lower(), '0x' + topics[2][-40:].lower()
+            if sender in runtime.project_address:
+                # 提现的暂时不要
+                continue
+            if receiver not in self.watch_address:
+                continue
+            coin = contracts.get(log['address'].lower())
+            if coin is None:
+                continue
+            key = (log['transactionHash'].lower(), coin['coin_id'])
+            if key in seen:
+                # 同一交易同一币种只记录一笔
+                self.logger.warning('交易 {} 存在多笔 {} 充值, 只记录第一笔'.format(key[0], coin['coin_name']))
+                continue
+            seen.add(key)
+            hits.append((log, coin, sender, receiver))
+
+        metrics.incr('txs_resolved', len(logs))
+        with metrics.timer('receipt_fetch_seconds'):
+            raw_txs = self.batch_rpc.get_transactions({log['transactionHash'] for log, _, _, _ in hits})
+        matched = []
+        for log, coin, sender, receiver in hits:
+            raw_tx = raw_txs.get(log['transactionHash'].lower())
+            if raw_tx is None:
+                raise SyncError('请求交易 {} 错误, 重新处理'.format(log['transactionHash']))
+            tx = EthereumResolver.resolver_transaction(raw_tx)
+            tx.sender, tx.receiver, tx.contract = sender, receiver, coin['contract']
+            tx.value = digit.hex_to_int(log['data']) if log.get('data') not in (None, '0x') else 0
+            block_height = digit.hex_to_int(log['blockNumber'])
+            matched.append((tx, coin, log['blockNumber'], block_height, block_timestamps[block_height]))
+        return matched
+
+    def fetch_receipts(self, matched):
+        """
+        一次批量请求获取整批命中交易的 receipt,
+        单块命中较多时整块获取, 其余按交易获取
+        :return: dict<tx_hash(小写), receipt>
+        """
+        if not matched:
+            return {}
+        tx_hashes = {tx.tx_hash: hex_height for tx, _, hex_height, _, _ in matched}
+        per_block = {}
+        for hex_height in tx_hashes.values():
+            per_block[hex_height] = per_block.get(hex_height, 0) + 1
+        block_heights = {h for h, count in per_block.items() if count >= self.BLOCK_RECEIPTS_THRESHOLD}
+        return self.batch_rpc.get_transaction_receipts(tx_hashes, block_heights)
+
+    def persist_blocks(self, batch):
+        """入库阶段: 一批块在同一事务中提交, 并推进同步高度"""
+        with runtime.app.app_context():
+            session = db.session()
+            try:
+                with batch.metrics.timer('db_write_seconds'):
+                    # 一批块与一批交易各一次写入
+                    block_ids = Block.add_blocks_or_update(batch.blocks, session=session, commit=False)
+                    for tx in batch.txs:
+                        tx['block_id'] = block_ids[tx['height']]
+                    Transaction.add_transactions_or_update(batch.txs, session=session, commit=False)
+                    # 回调队列与交易同一事务写入, 提交后即可推送
+                    enqueued = 0
+                    if batch.txs:
+                        heights = [tx['height'] for tx in batch.txs]
+                        enqueued = NotifyQueue.enqueue_pending(min_height=min(heights), max_height=max(heights),
+                                                               session=session)
+
+                    if self.lease is not None:
+                        # 分片模式只推进本区间进度, 安全高度由完成的租约合并得出
+                        if not ScanLease.heartbeat(self.lease.id, self.worker_id, batch.end_height,
+                                                   self.lease_ttl, session=session):
+                            raise SyncError('租约 {} 已被其他进程接手'.format(self.lease.id))
+                    elif self.update_cursor:
                         session.query(SyncConfig).filter(SyncConfig.id == self.config_id).update(
-                            {'synced_height': height + block_batch,
+                            {'synced_height': batch.end_height,
                              'highest_height': self.highest_height}
                         )
-                        self.current_scan_height = height + block_batch
-                        session.commit()
-                        self.logger.info("本次同步高度为：{} -- {}, 保存交易： {} 笔".format(height, height + block_batch, save_tx_count))
+                with batch.metrics.timer('commit_seconds'):
+                    session.commit()
+            except Exception:
+                session.rollback()
+                raise
+        if enqueued:
+            signal_outbox()
+        self.current_scan_height = batch.end_height
+        if batch.archive_records:
+            # 入库成功后再归档
+            self.archive.stage(batch.archive_records)
+            batch.archive_records = None
+        if self.archive is not None:
+            self.flush_archive()
+        self.logger.info("本次同步高度为：{} -- {}, 保存交易： {} 笔".format(
+            batch.height, batch.end_height, len(batch.txs)))
+        scan_metrics.observe(batch.metrics, batch.height, batch.end_height, self.highest_height)
+        return True
 
-                    except Exception as e:
-                        self.logger.error('同步块出现异常, 事务回滚. {}'.format(e))
-                        session.rollback()
-                        return
-        self.logger.info("扫链结束, 本次同步")
+
+@logger_attr
+class BackfillEthereumChain(ScanEthereumChain):
+    """
+    历史补扫
+    新增币种或导入旧地址后, 对指定高度区间只扫描这些地址或合约的充值.
+    与扫链同时运行, 不移动 SyncConfig 同步高度, 写入与扫链相同的 Transaction 表.
+    指定合约时使用日志过滤, 配置了本地归档时优先读取归档.
+    """
+
+    def __init__(self, start_height, end_height, addresses=None, contracts=None):
+        """
+        :param start_height: 起始高度, 包含
+        :param end_height: 结束高度, 不包含, 不超过 最新高度 - 延迟块数
+        :param addresses: list<str>, 只匹配这些地址, None 为全部地址
+        :param contracts: list<str>, 只匹配这些代币合约, 包含 COIN_NAME 时同时匹配主链币, None 为全部币种
+        """
+        super().__init__()
+        self.start_height = start_height
+        self.end_height = end_height
+        if addresses is not None:
+            self.watch_address = AddressIndex()
+            for address in addresses:
+                info = runtime.project_address.get(address)
+                if info is None:
+                    self.logger.warning('地址 {} 不是本钱包地址, 忽略'.format(address))
+                    continue
+                self.watch_address[address] = info
+        if contracts is not None:
+            self.watch_contracts = {contract.lower() for contract in contracts if contract != self.COIN_NAME}
+            self.scan_mode = self.SCAN_MODE_LOGS
+            self.scan_native = self.COIN_NAME in contracts
+        self.check_reorg = False
+        self.update_cursor = False
+        self.scan_to_tip = False
+
+    def backfill(self):
+        self.block_info = self.rpc.get_block_height()
+        self.newest_height = self.block_info.current_height
+        self.highest_height = self.block_info.highest_height
+        end_height = min(self.end_height, self.block_info.current_height - self.scan_delay)
+        self.current_scan_height = self.start_height
+        self.logger.info('开始补扫 {} -- {}, 地址 {} 个, 合约 {}'.format(
+            self.start_height, end_height, len(self.watch_address),
+            '全部' if self.watch_contracts is None else list(self.watch_contracts)))
+
+        pipeline = Pipeline([self.fetch_blocks, self.resolve_blocks, self.persist_blocks],
+                            maxsize=getattr(config, 'SCAN_PREFETCH_NUMBER', self.SCAN_PREFETCH_NUMBER))
+        try:
+            pipeline.run(self.iter_batches(end_height))
+        except Exception as e:
+            self.logger.error('补扫出现异常, 已补扫至 {}. {}'.format(self.current_scan_height, e))
+            return self.current_scan_height
+        self.logger.info('补扫结束, 已补扫至 {}'.format(self.current_scan_height))
+        return self.current_scan_height
 
 
 @logger_attr
@@ -180,54 +849,262 @@ class DepositEthereumChain(object):
     充值上账
     """
     COIN_NAME = 'Ethereum'
+    # 每次从队列取出的通知数量, 即分页大小
+    NOTIFY_BATCH = 1000
+    # 推送失败重试: 最多次数, 首次重试间隔及最大间隔, 秒
+    NOTIFY_MAX_ATTEMPTS = 12
+    NOTIFY_RETRY_BASE = 30
+    NOTIFY_RETRY_MAX = 6 * 3600
+    # 常驻上账检查队列的间隔及全表补漏的间隔, 秒
+    NOTIFY_POLL_SECONDS = 1
+    NOTIFY_RECONCILE_SECONDS = 300
+    # 进程内补漏进度: 已检查过的最大交易 id 及上次全表补漏时间
+    _reconcile_cursor = 0
+    _reconciled_at = 0
 
     def __init__(self):
-        self.project = {}
+        self.project = runtime.project
         self._init()
 
     def _init(self):
-        with runtime.app.app_context():
-            projects = Project.query.all()
-            for project in projects:
-                self.project.update(
-                    {project.id: {
-                        "name": project.name,
-                        "url": project.callback_url,
-                        "access_key": project.access_key,
-                        "secret_key": project.secret_key,
-                    }
-                    })
+        """项目从进程内缓存读取, 只同步变化的部分"""
+        ScanEthereumChain.sync_projects()
 
     def deposit(self):
         self.logger.info("开始上账进程")
+        self.reconcile()
+        total, succeeded = self.deliver()
+        self.logger.info("结束上账进程, 推送 {} 笔, 成功 {} 笔".format(total, succeeded))
+
+    def reconcile(self, full=None):
+        """
+        补漏, 扫链已在写入交易时加入队列, 这里处理遗漏的及旧版本写入的交易.
+        每 NOTIFY_RECONCILE_SECONDS 全表补漏一次, 其余只检查上次补漏之后新增的交易
+        :param full: 是否全表补漏, 默认按间隔决定
+        """
+        cls = DepositEthereumChain
+        if full is None:
+            reconcile_seconds = getattr(config, 'NOTIFY_RECONCILE_SECONDS', self.NOTIFY_RECONCILE_SECONDS)
+            full = time.time() - cls._reconciled_at >= reconcile_seconds
         with runtime.app.app_context():
-            no_push_txs = Transaction.query.filter(Transaction.is_send == SendEnum.NOT_PUSH.value)
-            for tx in no_push_txs:
-                receiver = tx.receiver
-                project_addr = runtime.project_address.get(receiver)
-                if not project_addr:
-                    continue
-                project = self.project.get(project_addr['project_id'])
-                tx_hash = tx.tx_hash
-                url = project['url']
-                params = {
-                    "txHash": tx.tx_hash,
-                    "blockHeight": tx.height,
-                    "amount": tx.amount,
-                    "address": tx.receiver,
-                    "orderid": uuid.uuid4().hex
-                }
+            session = db.session()
+            try:
+                max_id = Transaction.max_id()
+                enqueued = NotifyQueue.enqueue_pending(
+                    after_id=0 if full else cls._reconcile_cursor,
+                    page_size=getattr(config, 'NOTIFY_BATCH', self.NOTIFY_BATCH), session=session)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+        cls._reconcile_cursor = max_id
+        if full:
+            cls._reconciled_at = time.time()
+        if enqueued:
+            self.logger.info("补漏新增待推送通知 {} 条".format(enqueued))
+        return enqueued
+
+    def follow(self, stop_event=None):
+        """
+        常驻上账, 扫链提交新通知后立即推送.
+        同一进程的扫链通过 signal_outbox 唤醒, 其它进程写入的按 NOTIFY_POLL_SECONDS 检查队列最大 ID,
+        到期的重试同样在轮询时发现; 每 NOTIFY_RECONCILE_SECONDS 全表补漏
+        :param stop_event: threading.Event, 设置后退出
+        """
+        stop_event = stop_event or threading.Event()
+        poll_seconds = getattr(config, 'NOTIFY_POLL_SECONDS', self.NOTIFY_POLL_SECONDS)
+        reconcile_seconds = getattr(config, 'NOTIFY_RECONCILE_SECONDS', self.NOTIFY_RECONCILE_SECONDS)
+        cursor, next_due = 0, None
+        self.logger.info("常驻上账开始")
+        while not stop_event.is_set():
+            try:
+                # 地址及项目按各自间隔增量同步
+                ScanEthereumChain.sync_address()
+                self._init()
+                if time.time() - DepositEthereumChain._reconciled_at >= reconcile_seconds:
+                    self.reconcile(full=True)
+                # 先取游标, 推送期间新加入的通知留到下一轮
+                with runtime.app.app_context():
+                    cursor = NotifyQueue.max_id()
+                total, succeeded = self.deliver()
+                if total:
+                    self.logger.info("推送 {} 笔, 成功 {} 笔".format(total, succeeded))
+                with runtime.app.app_context():
+                    next_due = NotifyQueue.next_due_at()
+            except Exception as e:
+                self.logger.error('常驻上账出现异常, 等待下次推送. {}'.format(e))
+                next_due = None
+                stop_event.wait(poll_seconds)
+
+            while not stop_event.is_set():
+                if wait_outbox(poll_seconds):
+                    break
+                if time.time() - DepositEthereumChain._reconciled_at >= reconcile_seconds:
+                    break
+                if next_due is not None and next_due <= datetime.now():
+                    break
                 try:
-                    rsp = requests.post(url, params=params)
+                    with runtime.app.app_context():
+                        if NotifyQueue.max_id() > cursor:
+                            break
                 except Exception as e:
-                    self.logger.error("请求为 {} 上账不成功, 内容 {}, 错误： {}".format(project['name'], params, e))
-                    continue
-                if rsp.status_code == 200:
-                    session = db.session()
-                    session.query(Transaction).filter(tx.hash == tx_hash).update(
-                        {'is_send': SendEnum.PUSHED.value})
+                    self.logger.error('检查回调队列出现异常. {}'.format(e))
+        self.logger.info("常驻上账结束")
+
+    def deliver(self):
+        """
+        推送全部已到期的通知
+        :return: tuple<推送数量, 成功数量>
+        """
+        max_attempts = getattr(config, 'NOTIFY_MAX_ATTEMPTS', self.NOTIFY_MAX_ATTEMPTS)
+        retry_base = getattr(config, 'NOTIFY_RETRY_BASE', self.NOTIFY_RETRY_BASE)
+        retry_max = getattr(config, 'NOTIFY_RETRY_MAX', self.NOTIFY_RETRY_MAX)
+        # get_due 每页不超过 MAX_PAGE_SIZE, 取相同上限才能以不满一页判断已取完
+        limit = min(getattr(config, 'NOTIFY_BATCH', self.NOTIFY_BATCH), NotifyQueue.MAX_PAGE_SIZE)
+        total = succeeded = dead = skipped = 0
+        last_id = 0
+        with runtime.app.app_context():
+            session = db.session()
+            while True:
+                items = NotifyQueue.get_due(limit, last_id)
+                if not items:
+                    break
+                last_id = items[-1][0].id
+                notifications, obsolete, failures = [], [], []
+                for item, tx in items:
+                    if not NotifyQueue.is_current(item.event, tx):
+                        obsolete.append(item.id)
+                        continue
+                    notification = self.build_notification(item, tx)
+                    if notification is None:
+                        failures.append((item, '未找到地址所属项目'))
+                        continue
+                    notifications.append(notification)
+                # 按项目分通道推送, 熔断中的项目推迟到下一次探测
+                dispatcher = get_dispatcher()
+                results = dispatcher.dispatch(self.build_calls(notifications), lane=self.lane)
+
+                # 推送成功的按字段及推送时的确认状态分组, 每组一次更新
+                done, pushed, postponed = list(obsolete), {}, {}
+                for result in results:
+                    if result.skipped:
+                        project_id = self.lane(result.key)
+                        postponed.setdefault(project_id, []).extend(
+                            notification.item.id for notification in result.key[0])
+                        skipped += len(result.key[0])
+                        continue
+                    for notification, ok, error in self.parse_result(result):
+                        total += 1
+                        if ok:
+                            succeeded += 1
+                            done.append(notification.item.id)
+                            pushed.setdefault((notification.send_field, notification.tx.confirm_status),
+                                              []).append(notification.tx.id)
+                        else:
+                            failures.append((notification.item, error))
+                            self.logger.error("请求为 {} 上账不成功, 内容 {}, 错误： {}".format(
+                                self.project[notification.project_id]['name'], notification.params, error))
+                try:
+                    NotifyQueue.mark_done(done, commit=False, session=session)
+                    for project_id, ids in postponed.items():
+                        NotifyQueue.postpone(ids, max(dispatcher.breaker(project_id).retry_after(), 1), '回调熔断中',
+                                             commit=False, session=session)
+                    dead += NotifyQueue.mark_failed(failures, max_attempts, retry_base, retry_max,
+                                                    commit=False, session=session)
+                    for (send_field, confirm_status), tx_ids in pushed.items():
+                        Transaction.mark_pushed(tx_ids, send_field, confirm_status, commit=False, session=session)
                     session.commit()
-        self.logger.info("结束上账进程")
+                except Exception:
+                    session.rollback()
+                    raise
+                if len(items) < limit:
+                    break
+        if dead:
+            self.logger.error("{} 条通知多次推送失败, 已进入死信".format(dead))
+        if skipped:
+            self.logger.warning("{} 条通知所属项目回调熔断中, 已推迟".format(skipped))
+        return total, succeeded
+
+    def build_notification(self, item, tx):
+        """生成一条充值通知, 地址不属于任何项目时返回 None"""
+        project_addr = runtime.project_address.get(tx.receiver)
+        if not project_addr or project_addr['project_id'] not in self.project:
+            return None
+        params = {
+            "txHash": tx.tx_hash,
+            "blockHeight": tx.height,
+            "amount": tx.amount,
+            "address": tx.receiver,
+            "confirmStatus": NotifyQueue.EVENT_NAMES[item.event],
+            "orderid": uuid.uuid4().hex
+        }
+        return Notification(item, tx, NotifyQueue.EVENT_SEND_FIELDS[item.event], project_addr['project_id'], params)
+
+    def batch_size(self, project_id):
+        """项目的批量回调大小, 未开启返回 0"""
+        batch_projects = getattr(config, 'NOTIFY_BATCH_PROJECTS', None) or {}
+        return int(batch_projects.get(project_id) or batch_projects.get(str(project_id)) or 0)
+
+    def build_calls(self, notifications):
+        """
+        生成回调请求, 未开启批量回调的项目每笔一个请求,
+        开启的项目每 NOTIFY_BATCH_PROJECTS[project_id] 笔合并为一个签名的 JSON 请求
+        :return: list<tuple<tuple<list<Notification>, 是否批量>, url, dict>>
+        """
+        calls, batches = [], {}
+        for notification in notifications:
+            if self.batch_size(notification.project_id):
+                batches.setdefault(notification.project_id, []).append(notification)
+                continue
+            project = self.project[notification.project_id]
+            calls.append((([notification], False), project['url'], {"params": notification.params}))
+        for project_id, items in batches.items():
+            project = self.project[project_id]
+            size = self.batch_size(project_id)
+            for idx in range(0, len(items), size):
+                chunk = items[idx:idx + size]
+                calls.append(((chunk, True), project['url'], {"json": self.sign_batch(project, chunk)}))
+        return calls
+
+    @staticmethod
+    def lane(key):
+        """回调请求所属通道, 即项目 id"""
+        notifications, _ = key
+        return notifications[0].project_id
+
+    @staticmethod
+    def sign_batch(project, notifications):
+        """
+        批量回调请求体, 签名方式同接口签名: 除 accessKey 及 signsture 外按键排序拼接 key=value,
+        以项目 secret_key 签名.
+        deposits 为 JSON 字符串, 每项带 notifyId, 项目方以 {"acked": [notifyId, ...]} 逐笔确认
+        """
+        deposits = [dict(notification.params, notifyId=notification.item.id) for notification in notifications]
+        data = {
+            "accessKey": project['access_key'],
+            "timestamp": time.time(),
+            "deposits": json.dumps(deposits, separators=(',', ':'), sort_keys=True),
+        }
+        data['signsture'] = sign_data(order_data(data), project['secret_key'])
+        return data
+
+    @staticmethod
+    def parse_result(result):
+        """
+        回调结果拆分到每笔通知
+        :return: list<tuple<Notification, ok, error>>
+        """
+        notifications, batch = result.key
+        if not result.ok:
+            return [(notification, False, result.error) for notification in notifications]
+        if not batch:
+            return [(notification, True, None) for notification in notifications]
+        try:
+            acked = set(json.loads(result.body).get('acked') or [])
+        except (ValueError, TypeError, AttributeError):
+            return [(notification, False, '批量回调响应格式错误') for notification in notifications]
+        return [(notification, notification.item.id in acked, None if notification.item.id in acked else '项目未确认')
+                for notification in notifications]
 
 
 @logger_attr
@@ -242,19 +1119,37 @@ class ProjectAddressInitMixin(object):
                     "project_id": addr_info['project_id'],
                     "address": [addr]
                 }
+        # 密码及热钱包密钥未变化时使用已校验的钱包密码
+        ScanEthereumChain.sync_projects()
+        registry = runtime.project
         with runtime.app.app_context():
-            for pk, project in self.project_addresses.items():
-                project_id = project['project_id']
+            for project_id in list(self.project_addresses):
                 coin_name = self.COIN_NAME
-                project_coin = ProjectCoin.get_pro_coin_by_pid_cname(project_id, coin_name)
                 is_valid_secret, secret_result = get_secret(project_id, coin_name)
                 if not is_valid_secret:
-                    self.logger.error("归集程序未设置密码..")
-                    raise PasswordError("归集程序未设置密码..")
+                    # 密码只通过接口设置在 web 进程内存中, 未设置时跳过该项目
+                    self.logger.warning("项目 {} 未设置钱包密码, 跳过".format(project_id))
+                    del self.project_addresses[project_id]
+                    continue
                 secret = secret_result
-                is_valid, result, passphrase, rpc = check_passphrase(project_coin, secret)
-                self.rpc = rpc
+                passphrase = registry.get_passphrase(project_id, coin_name, secret)
+                if passphrase is None:
+                    project_coin = registry.get_project_coin(project_id, coin_name)
+                    if project_coin is None:
+                        self.logger.error("项目 {} 未配置币种 {}".format(project_id, coin_name))
+                        del self.project_addresses[project_id]
+                        continue
+                    is_valid, result, passphrase, rpc = check_hot_wallet(
+                        project_coin['hot_pk'], project_coin['hot_address'], secret)
+                    self.rpc = rpc
+                    if not is_valid:
+                        self.logger.error("项目 {} 钱包密码无效, 跳过".format(project_id))
+                        del self.project_addresses[project_id]
+                        continue
+                    registry.set_passphrase(project_id, coin_name, secret, passphrase)
                 self.project_addresses[project_id]['passphrase'] = passphrase
+            if self.rpc is None and self.project_addresses:
+                self.rpc = RpcConfig.get_rpc()
 
 
 @logger_attr
@@ -412,20 +1307,48 @@ class RenderFee(ProjectAddressInitMixin):
 
 
 def run_sync():
+    ScanEthereumChain.sync_address()
     eth_chain = ScanEthereumChain()
-    eth_chain.scan()
+    if getattr(config, 'SCAN_SHARDED', False):
+        eth_chain.scan_sharded()
+    else:
+        eth_chain.scan()
+
+
+def run_follow(stop_event=None):
+    """常驻扫链, 在 JOBS 中以一次性任务配置, 不与 run_sync 同时使用"""
+    ScanEthereumChain.sync_address()
+    eth_chain = ScanEthereumChain()
+    eth_chain.follow(stop_event)
+
+
+def run_backfill(start_height, end_height, addresses=None, contracts=None):
+    """历史补扫, 可在 JOBS 中以 kwargs 配置或由 scripts/backfill.py 调用"""
+    ScanEthereumChain.sync_address()
+    eth_backfill = BackfillEthereumChain(start_height, end_height, addresses, contracts)
+    return eth_backfill.backfill()
 
 
 def notify_project():
+    ScanEthereumChain.sync_address()
     eth_notify = DepositEthereumChain()
     eth_notify.deposit()
 
 
+def run_notifier(stop_event=None):
+    """常驻上账, 在 JOBS 中以一次性任务配置, 不与 notify_project 同时使用"""
+    ScanEthereumChain.sync_address()
+    eth_notify = DepositEthereumChain()
+    eth_notify.follow(stop_event)
+
+
 def collection_eth():
+    ScanEthereumChain.sync_address()
     eth_collect = CollectionEthereumChain()
     eth_collect.collection()
 
 
 def render_eth():
+    ScanEthereumChain.sync_address()
     eth_render = RenderFee()
     eth_render.render()
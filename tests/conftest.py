@@ -0,0 +1,48 @@
+"""
+测试环境
+
+log、exceptions、digit 来自 wallet_common, 未安装时以最小实现代替,
+只用于测试不依赖节点及数据库的组件(回调推送、地址索引、重组检测等).
+"""
+import importlib
+import logging
+import sys
+import types
+
+
+def _stub(name, **attrs):
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
+
+
+def _logger_attr(cls):
+    cls.logger = logging.getLogger(cls.__name__)
+    return cls
+
+
+class _SyncError(Exception):
+    pass
+
+
+class _PasswordError(Exception):
+    pass
+
+
+def _hex_to_int(value):
+    return int(value, 16) if isinstance(value, str) else value
+
+
+def _int_to_hex(value):
+    return hex(value)
+
+
+_stub('log', logger_attr=_logger_attr)
+_stub('exceptions', SyncError=_SyncError, PasswordError=_PasswordError)
+_stub('digit')
+_stub('digit.digit', hex_to_int=_hex_to_int, int_to_hex=_int_to_hex)
+if not hasattr(sys.modules['digit'], 'digit'):
+    sys.modules['digit'].digit = sys.modules['digit.digit']
@@ -0,0 +1,51 @@
+import threading
+import time
+
+from tasks.notify import CallbackDispatcher, CallbackResult
+
+
+def make_dispatcher(**kwargs):
+    dispatcher = CallbackDispatcher(**kwargs)
+    state = {"inflight": {}, "peak": {}}
+    lock = threading.Lock()
+
+    def post(key, url, **_):
+        lane = key[0]
+        with lock:
+            state['inflight'][lane] = state['inflight'].get(lane, 0) + 1
+            state['peak'][lane] = max(state['peak'].get(lane, 0), state['inflight'][lane])
+        time.sleep(0.05)
+        with lock:
+            state['inflight'][lane] -= 1
+        return CallbackResult(key, lane != 'bad', error=None if lane != 'bad' else 'HTTP 500')
+
+    dispatcher.post = post
+    return dispatcher, state
+
+
+def test_lane_reaches_inflight_limit():
+    dispatcher, state = make_dispatcher(max_workers=32, lane_inflight=4)
+    calls = [(('p1', i), 'http://p1', {}) for i in range(20)]
+    results = dispatcher.dispatch(calls, lane=lambda key: key[0])
+    assert state['peak']['p1'] == 4
+    assert [result.key for result in results] == [key for key, _, _ in calls]
+    assert all(result.ok for result in results)
+
+
+def test_lanes_share_global_slots():
+    dispatcher, state = make_dispatcher(max_workers=6, lane_inflight=4)
+    calls = [((lane, i), 'http://x', {}) for lane in ('p1', 'p2') for i in range(12)]
+    dispatcher.dispatch(calls, lane=lambda key: key[0])
+    assert state['peak']['p1'] <= 4 and state['peak']['p2'] <= 4
+    assert state['peak']['p1'] + state['peak']['p2'] >= 6
+
+
+def test_open_breaker_skips_lane_only():
+    dispatcher, _ = make_dispatcher(max_workers=8, lane_inflight=1, breaker_failures=3, breaker_reset=60)
+    calls = [((lane, i), 'http://x', {}) for lane in ('bad', 'good') for i in range(10)]
+    results = dispatcher.dispatch(calls, lane=lambda key: key[0])
+    bad = [result for result in results if result.key[0] == 'bad']
+    good = [result for result in results if result.key[0] == 'good']
+    assert sum(not result.skipped for result in bad) == 3
+    assert all(result.skipped for result in bad[3:])
+    assert all(result.ok for result in good)